@@ -0,0 +1,136 @@
+import numpy as np
+
+KM_PER_FOOTPRINT = 5. #~5km per footprint (we have overlap, makes it complicated), probably ok-ish if we're consistent
+
+
+def run_lengths(mask, axis=0, return_index=False):
+    """
+    Lengths of every run of consecutive True values along an axis, for all other positions at once.
+
+    The mask is padded with False at both ends of every ray, so runs never join across rays and
+    np.diff finds all run starts (+1) and ends (-1) of the whole array in one pass.
+
+    Parameters
+    ----------
+    mask : array-like
+        Boolean (or 0/1) array of any shape.
+    axis : int
+        Axis along which runs are counted (e.g. along-track).
+    return_index : bool
+        Also return the ray (flat index over the other axes) and position where each run starts.
+
+    Returns
+    -------
+    numpy.ndarray
+        Run lengths, ordered by ray (other axes in C order) then position along the axis.
+    numpy.ndarray, numpy.ndarray
+        Ray and start position of each run, if return_index.
+    """
+    mask = np.moveaxis(np.asarray(mask, dtype=bool), axis, -1)
+    n = mask.shape[-1]
+    rays = mask.reshape(-1, n)
+    padded = np.zeros((rays.shape[0], n + 2), dtype=np.int8)
+    padded[:, 1:-1] = rays
+    edges = np.diff(padded, axis=-1).ravel() #rows of n+1
+    starts = np.flatnonzero(edges == 1)
+    lengths = np.flatnonzero(edges == -1) - starts
+    if return_index:
+        return lengths, starts // (n + 1), starts % (n + 1)
+    return lengths
+
+
+def flatten_clouds(binary_2dmask):
+    """
+    essentially just flatten height-dimension for a top-down POV, if there's a cloud at any level its cloudy
+    expects shape (..., nheight)
+    """
+    return np.any(binary_2dmask, axis=-1).astype(np.int8)
+
+
+def calc_cloud_lengths(binary_data, km_per_footprint=KM_PER_FOOTPRINT):
+    """
+    Function to calculate continuous stretches of '1s' (representing clouds) broken up by '0s' (clear)
+    used to calc. cloud length scales
+    """
+    return run_lengths(binary_data) * km_per_footprint
+
+
+def cloud_chord_lengths(cloud_mask, km_per_footprint=KM_PER_FOOTPRINT):
+    """
+    Cloud chord lengths (km) along-track for every cross-track column of an orbit's cloud mask,
+    seen from above (cloudy if there's a cloud at any level).
+    Same as concatenating calc_cloud_lengths(flatten_clouds(cloud_mask[:,x])) over each column x.
+
+    Parameters
+    ----------
+    cloud_mask : numpy.ndarray
+        Cloud mask. Dimensions: (atrack, xtrack, zlevels) or already flattened (atrack, xtrack)
+
+    Returns
+    -------
+    numpy.ndarray
+        Chord lengths in km.
+    """
+    cloud_mask = np.asarray(cloud_mask)
+    if cloud_mask.ndim == 3:
+        cloud_mask = flatten_clouds(cloud_mask)
+    return run_lengths(cloud_mask, axis=0) * km_per_footprint
+
+
+class LogHistogram:
+    """
+    Streaming histogram on fixed (e.g. log-spaced) bins, updated batch by batch (orbit by orbit)
+    and merged across workers, so every chord length never has to be held in memory.
+    Counts match numpy.histogram on the same bins; values outside the bins are counted separately.
+
+    Parameters
+    ----------
+    bins : array-like
+        Monotonically increasing bin edges, e.g. np.logspace(0, 4, 100).
+    """
+    def __init__(self, bins):
+        self.bins = np.asarray(bins, dtype=float)
+        self.counts = np.zeros(len(self.bins) - 1, dtype=np.int64)
+        self.below = 0
+        self.above = 0
+
+    def update(self, values):
+        """
+        Add values to the histogram.
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        ind = np.searchsorted(self.bins, values, side='right') - 1
+        ind[values == self.bins[-1]] = len(self.counts) - 1 #last bin includes its right edge, as numpy.histogram
+        inside = (ind >= 0) & (ind < len(self.counts))
+        self.counts += np.bincount(ind[inside], minlength=len(self.counts))
+        self.below += np.count_nonzero(ind < 0)
+        self.above += np.count_nonzero(ind >= len(self.counts))
+        return self
+
+    def merge(self, other):
+        """
+        Add the counts of another histogram with the same bins (e.g. from another worker).
+        """
+        if not np.array_equal(self.bins, other.bins):
+            raise ValueError('Can only merge histograms with the same bins')
+        self.counts += other.counts
+        self.below += other.below
+        self.above += other.above
+        return self
+
+    def __add__(self, other):
+        return LogHistogram(self.bins).merge(self).merge(other)
+
+    @property
+    def centers(self):
+        return (self.bins[:-1] + self.bins[1:]) / 2
+
+    @property
+    def total(self):
+        return int(self.counts.sum())
+
+    def density(self):
+        """
+        Counts per unit bin width, e.g. the number density N(L) of chord lengths.
+        """
+        return self.counts / np.diff(self.bins)
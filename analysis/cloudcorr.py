@@ -0,0 +1,455 @@
+import os
+import zlib
+import numpy as np
+import netCDF4 as nc4
+import threading
+from collections import deque
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+FillValue = -9999.0
+NCLOUD_MAX = 36 #PCRTM only allows 36 cloud layers
+
+
+def cloud_mask_calc(CF_profile,
+                    CM_profile_previous,
+                    QI_profile,
+                    QL_profile,
+                    pres_profile,
+                    surface_pres,
+                    alpha):
+    """
+    Written by Kyle Mattingly
+    Cloud correlation updates by Cameron Bertossa
+    
+    Determine cloud mask for each vertical layer of a single profile using a 
+    max-overlap like assumption applied to cloud fraction profile:
+    
+    Find CFMax in profile. Draw random number for CFmax at the layer of CFmax.
+    - If clear, then the entire profile is clear.
+    - If cloudy, set layer of CFmax to cloudy, and then do random draws in the
+      rest of the profile according to (CFprofile / CFmax).
+      
+    Since PCRTM only allows 36 cloud layers: after creating the intial cloud
+    mask profile, check if the number of cloud levels is less than 37. If true,
+    do nothing; if >= 37, change cloud layers to clear to get down to 36, by
+    "removing" the cloud layers with the smallest (qi + ql) values.
+    
+    Since PCRTM can't handle below-surface cloud layers: find the layers in each
+    profile where the pressure is greater than the surface pressure. Then zero out
+    cloud mask, cloud fraction, QI, and QL on all these layers *except* the first
+    below-surface layer.
+    
+    Parameters
+    ----------
+    CF_profile : numpy.ndarray
+        Cloud fraction profile for a single TIRS scene.
+        Dimensions: (zlevels)
+    CM_profile_previous : numpy.ndarray
+        Cloud mask profile for a single TIRS scene which precedes the current
+        scene in the atrack direction.
+        Dimensions: (zlevels)
+    QI_profile : numpy.ndarray
+        QI profile for a single TIRS scene.
+        Dimensions: (zlevels)
+    QL_profile : numpy.ndarray
+        QL profile for a single TIRS scene.
+        Dimensions: (zlevels)
+    pres_profile : numpy.ndarray
+        Pressure profile for a single TIRS scene.
+        Dimensions: (zlevels)
+    surface_pres : float
+        Surface pressure for a single TIRS scene.
+    alpha : float
+        cloud decoupling parameter (bigger = less influence from previous footprint);
+        in the limit of alpha -> infty cloud fields are randomly sampled
+
+    Returns
+    -------
+    cloud_mask_profile : numpy.ndarray
+        Cloud mask profile with below-surface layers zeroed out.
+        Dimensions: (zlevels)
+    CF_profile : numpy.ndarray
+        Cloud fraction profile with below-surface layers zeroed out.
+        Dimensions: (zlevels)
+    QI_profile : numpy.ndarray
+        QI profile with below-surface layers zeroed out.
+        Dimensions: (zlevels)
+    QL_profile : numpy.ndarray
+        QL profile with below-surface layers zeroed out.
+        Dimensions: (zlevels)
+
+    """
+    
+    # Adapted from /home/merrelli/projects/PREFIRE_misc/GEOS_cloudfraction.py
+
+    #adjust CF to account for previous scene's mask result, then clip to be [0,1]
+    CF_profile = np.clip(CF_profile - ((-1)**CM_profile_previous)/alpha, a_min=0, a_max=1)
+
+    CF_max_layer = CF_profile.argmax()
+    CF_profile_max = CF_profile[CF_max_layer]
+    # Compute a scaled profile where the max CF is 100%.
+    CF_profile_scaled = CF_profile / CF_profile_max
+    
+    nlayers = CF_profile.shape[0]
+    cloud_mask_profile_full = np.zeros(CF_profile.shape, dtype='int8')
+    # for max overlap: draw scalar random number to decide if the profile
+    # is cloudy or not....
+    if np.random.uniform(0,1,1) < CF_profile_max:
+        # ... if cloudy, then decide which layers have cloud by drawing
+        # random numbers against the scaled profile. Since this has a peak of 100%,
+        # we should automatically get at least one cloud layer at the layer that
+        # has the peak CF.
+        cloud_mask_profile_full[:] = np.random.uniform(0,1,(nlayers,)) < CF_profile_scaled
+    # (if clear, entire cloud mask profile remains 0.)
+    
+    # If number of cloud levels is < 37, keep cloud mask profile as is
+    if np.sum(cloud_mask_profile_full) < 37:
+        cloud_mask_profile = cloud_mask_profile_full
+        
+    # If number of cloud levels is >= 37, remove cloud layers with the smallest
+    # (qi + ql) values, to get down to 36 cloud levels.
+    else:
+        # In determining the 36 largest qcloud (qi + ql) values, consider *only* 
+        # the values where cloud mask = 1.
+        qi_mask = np.where(cloud_mask_profile_full == 1, QI_profile, 0)
+        ql_mask = np.where(cloud_mask_profile_full == 1, QL_profile, 0)
+        qcloud_thresh = np.sort(qi_mask + ql_mask)[::-1][35]
+        cloud_mask_profile = np.where((qi_mask + ql_mask) >= qcloud_thresh, 1, 0)
+        
+        # Break "ties" where more than one level has qi_mask + ql_mask == qcloud_thresh
+        # - Set cloud_mask equal to 0 in these cases
+        if np.sum(cloud_mask_profile) > 36:
+            cloud_mask_profile[(qi_mask + ql_mask) == qcloud_thresh] = 0
+    
+    # Keep data from the first level with pressure > surface pressure, because it 
+    # contains unique data (different from first above-surface level), and shouldn't 
+    # cause PCRTM to break.
+    below_sfc_ixs = np.where(pres_profile > surface_pres)[0][1:]
+    cloud_mask_profile[below_sfc_ixs] = 0
+    CF_profile[below_sfc_ixs] = 0
+    QI_profile[below_sfc_ixs] = 0
+    QL_profile[below_sfc_ixs] = 0
+            
+    return cloud_mask_profile, CF_profile, QI_profile, QL_profile
+
+
+#variables of each group read by orbit_extract, in the order it returns them
+ORBIT_VARIABLES = {'Geometry': ('longitude', 'latitude'),
+                   'Anc-SimTruth': ('cloud_mask', 'cloud_fraction', 'qi', 'ql', 'surface_pressure', 'pressure_profile')}
+
+#the HDF5 library is usually not thread-safe, so reads are serialized (as xarray does)
+_NC_LOCK = threading.Lock()
+
+
+def _read_dtype(var):
+    #dtype of a variable as read by _read_variable: netCDF4 unpacks scale_factor/add_offset to float,
+    #and integers with a fill value become float so missing values can be NaN
+    packing = [np.asarray(var.getncattr(a)).dtype for a in ('scale_factor', 'add_offset') if a in var.ncattrs()]
+    dtype = np.result_type(var.dtype, *packing)
+    if dtype.kind != 'f' and ('_FillValue' in var.ncattrs() or 'missing_value' in var.ncattrs()):
+        dtype = np.dtype(np.float64)
+    return dtype
+
+
+def _read_variable(var, layers=None):
+    #read a netCDF4 variable, only the requested layers of profiles (atrack, xtrack, zlev)
+    data = var[..., layers] if (layers is not None and var.ndim == 3) else var[...]
+    data = np.ma.asarray(data).astype(_read_dtype(var), copy=False)
+    if np.ma.isMaskedArray(data):
+        data = data.filled(np.nan) if data.dtype.kind == 'f' else data.data
+    return data
+
+
+def _orbit_layout(path, variables, layers=None):
+    #shape and dtype of each variable, from the file's metadata only
+    with _NC_LOCK, nc4.Dataset(path) as ds:
+        out = {}
+        for group, names in variables.items():
+            for name in names:
+                var = ds[group][name]
+                shape = var.shape
+                if layers is not None and var.ndim == 3:
+                    shape = shape[:2] + (len(np.arange(shape[2])[layers]),)
+                out[name] = (shape, _read_dtype(var))
+        return out
+
+
+def read_orbit(path, variables=ORBIT_VARIABLES, layers=None, out=None):
+    """
+    Read variables of an orbit sim file, opening it once and reading only the requested variables and layers.
+
+    Parameters
+    ----------
+    path : str
+        Orbit (*Truth*) file.
+    variables : dict
+        Names of the variables to read from each group.
+    layers : slice or numpy.ndarray, optional
+        Vertical layers to read from profile variables (atrack, xtrack, zlev), all if None.
+    out : dict, optional
+        Arrays to read into (e.g. slices of preallocated multi-orbit arrays).
+
+    Returns
+    -------
+    dict
+        numpy arrays of each variable, missing values are NaN in float variables.
+    """
+    out = {} if out is None else out
+    with _NC_LOCK, nc4.Dataset(path) as ds:
+        for group, names in variables.items():
+            for name in names:
+                data = _read_variable(ds[group][name], layers)
+                if name in out:
+                    out[name][...] = data
+                else:
+                    out[name] = data
+    return out
+
+
+def read_orbits(paths, variables=ORBIT_VARIABLES, layers=None):
+    """
+    Read many orbit files into arrays concatenated along-track (the first dimension).
+
+    Output arrays are preallocated from the files' metadata and each file is read straight into its
+    slice, so there's no repeated copying as when stacking orbit by orbit. Reads are serialized
+    (HDF5 isn't thread-safe), use iter_orbits to overlap reading with processing.
+
+    Parameters
+    ----------
+    paths : list
+        Orbit (*Truth*) files.
+    variables : dict
+        Names of the variables to read from each group.
+    layers : slice or numpy.ndarray, optional
+        Vertical layers to read from profile variables.
+
+    Returns
+    -------
+    dict
+        numpy arrays of each variable, concatenated along-track in the order of paths.
+    numpy.ndarray
+        Along-track index where each orbit starts (plus the total at the end).
+    """
+    layouts = [_orbit_layout(path, variables, layers) for path in paths]
+    names = list(layouts[0])
+    starts = np.cumsum([0] + [layout[names[0]][0][0] for layout in layouts])
+    out = {name: np.empty((starts[-1],) + shape[1:], dtype=dtype)
+           for name, (shape, dtype) in layouts[0].items()}
+    for path, s0, s1 in zip(paths, starts[:-1], starts[1:]):
+        read_orbit(path, variables, layers, {name: a[s0:s1] for name, a in out.items()})
+    return out, starts
+
+
+def iter_orbits(paths, variables=ORBIT_VARIABLES, layers=None, prefetch=2):
+    """
+    Yield one orbit at a time, for pipelines that don't need every orbit in memory.
+    The next orbits are read in the background while the current one is being used.
+
+    Yields
+    ------
+    str
+        Path of the orbit file.
+    dict
+        numpy arrays of each variable (see read_orbit).
+    """
+    with ThreadPoolExecutor(max(prefetch, 1)) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append((path, pool.submit(read_orbit, path, variables, layers)))
+            if len(pending) > prefetch:
+                path0, job = pending.popleft()
+                yield path0, job.result()
+        while pending:
+            path0, job = pending.popleft()
+            yield path0, job.result()
+
+
+def orbit_extract(AncSimfile):
+    """
+    Simple function to extract GEOS cloudfrac/cloudmask interpolated onto TIRS footprints from an orbit sim file
+    lats (atrack, xtrack)
+    lons (atrack, xtrack)
+    cmaskz (atrack,xtrack,zlev)
+    cfracz (atrack,xtrack,zlev)
+    """
+    orbit = read_orbit(AncSimfile)
+    return tuple(orbit[name] for names in ORBIT_VARIABLES.values() for name in names)
+
+
+def below_surface_layers(pres_profiles, surface_pres):
+    """
+    Layers to zero out for PCRTM: pressure greater than the surface pressure, except the first such
+    layer of each profile (it contains unique data and doesn't break PCRTM).
+
+    Parameters
+    ----------
+    pres_profiles : numpy.ndarray
+        Pressure profiles. Dimensions: (..., zlevels)
+    surface_pres : numpy.ndarray
+        Surface pressure. Dimensions: (...)
+
+    Returns
+    -------
+    numpy.ndarray
+        True where a layer is zeroed out. Dimensions: (..., zlevels)
+    """
+    below = pres_profiles > surface_pres[..., None]
+    return below & (np.cumsum(below, axis=-1) > 1)
+
+
+def cap_cloud_layers(cloud_mask, qcloud, nmax=NCLOUD_MAX):
+    """
+    Batched version of the cloud layer cap in cloud_mask_calc: profiles with more than nmax cloud layers
+    keep only the layers with the nmax largest (qi + ql) values, found with a partial sort. Levels tied
+    with the threshold are set clear if that still leaves more than nmax layers.
+
+    Parameters
+    ----------
+    cloud_mask : numpy.ndarray
+        Boolean cloud mask profiles, modified in place. Dimensions: (nprofile, zlevels)
+    qcloud : numpy.ndarray
+        qi + ql profiles. Dimensions: (nprofile, zlevels)
+
+    Returns
+    -------
+    numpy.ndarray
+        cloud_mask
+    """
+    nlev = cloud_mask.shape[-1]
+    if nlev <= nmax:
+        return cloud_mask
+    over = np.flatnonzero(cloud_mask.sum(axis=-1) > nmax)
+    if len(over) == 0:
+        return cloud_mask
+    q = np.where(cloud_mask[over], qcloud[over], 0)
+    thresh = np.partition(q, nlev - nmax, axis=-1)[:, nlev - nmax, None] #nmax-th largest
+    capped = q >= thresh
+    ties = capped.sum(axis=-1) > nmax
+    capped[ties] &= q[ties] != thresh[ties]
+    cloud_mask[over] = capped
+    return cloud_mask
+
+
+def apply_cloud_mask(CF_profiles_allscenes,
+                     QI_profiles_allscenes,
+                     QL_profiles_allscenes,
+                     pres_profiles_allscenes,
+                     surface_pres_allscenes,
+                     random_seed=139, alpha=3, rng=None, block=256):
+    """
+    Apply the cloud mask calculation of cloud_mask_calc to all TIRS scenes in a given orbit file.
+
+    The along-track correlation (each scene's cloud fraction is adjusted by the previous scene's
+    mask) is the only sequential dependency, so the orbit is stepped along-track once and every
+    cross-track footprint and layer of a step is done with array operations. Random numbers come
+    from a numpy.random.Generator, drawn in blocks of along-track steps. Unlike cloud_mask_calc,
+    the input arrays are not modified.
+
+    Parameters
+    ----------
+    CF_profiles_allscenes : numpy.ndarray
+        Cloud fraction profiles for all TIRS scenes in a given orbit file.
+        Dimensions: (atrack, xtrack, zlevels)
+    QI_profiles_allscenes : numpy.ndarray
+        QI profiles. Dimensions: (atrack, xtrack, zlevels)
+    QL_profiles_allscenes : numpy.ndarray
+        QL profiles. Dimensions: (atrack, xtrack, zlevels)
+    pres_profiles_allscenes : numpy.ndarray
+        Pressure profiles (*after* interpolation to PCRTM levels).
+        Dimensions: (atrack, xtrack, zlevels)
+    surface_pres_allscenes : numpy.ndarray
+        Surface pressure. Dimensions: (atrack, xtrack)
+    random_seed : int
+        Seed of the random stream, used if rng is not given.
+    alpha : float
+        cloud decoupling parameter (bigger = less influence from previous footprint)
+    rng : numpy.random.Generator, optional
+        Random stream to draw from.
+    block : int
+        Number of along-track steps drawn at once.
+
+    Returns
+    -------
+    cloud_mask_3d : numpy.ndarray
+        Cloud mask profiles. Dimensions: (atrack, xtrack, zlevels)
+    CF_adj_3d : numpy.ndarray
+        Cloud fraction adjusted with zeroed out below-surface layers.
+    QI_adj_3d : numpy.ndarray
+        QI adjusted with zeroed out below-surface layers.
+    QL_adj_3d : numpy.ndarray
+        QL adjusted with zeroed out below-surface layers.
+    """
+    if rng is None:
+        rng = np.random.default_rng(random_seed)
+    CF = np.asarray(CF_profiles_allscenes)
+    natrack, nxtrack, nlev = CF.shape
+    below = below_surface_layers(np.asarray(pres_profiles_allscenes), np.asarray(surface_pres_allscenes))
+    qcloud = np.asarray(QI_profiles_allscenes) + np.asarray(QL_profiles_allscenes)
+
+    cloud_mask_3d = np.zeros(CF.shape, dtype='int8')
+    CF_adj_3d = np.zeros(CF.shape, dtype=CF.dtype)
+    previous = np.zeros((nxtrack, nlev), dtype=bool) #the first scene has no (i.e. a clear) previous scene
+    for a0 in range(0, natrack, block):
+        nb = min(block, natrack - a0)
+        u_profile = rng.random((nb, nxtrack)) #is the profile cloudy?
+        u_layer = rng.random((nb, nxtrack, nlev)) #which layers, against the scaled profile
+        for i in range(nb):
+            a = a0 + i
+            #adjust CF to account for previous scene's mask result, then clip to be [0,1]
+            cf = np.clip(CF[a] - np.where(previous, -1., 1.)/alpha, 0, 1)
+            cf_max = cf.max(axis=-1)
+            #max overlap, u < cf/cf_max without dividing, at least the layer of max CF is cloudy
+            mask = (u_profile[i] < cf_max)[:, None] & (u_layer[i] * cf_max[:, None] < cf)
+            mask = cap_cloud_layers(mask, qcloud[a])
+            mask &= ~below[a]
+            cloud_mask_3d[a] = mask
+            CF_adj_3d[a] = cf
+            previous = mask
+
+    CF_adj_3d[below] = 0
+    QI_adj_3d = np.where(below, 0, QI_profiles_allscenes).astype(np.asarray(QI_profiles_allscenes).dtype)
+    QL_adj_3d = np.where(below, 0, QL_profiles_allscenes).astype(np.asarray(QL_profiles_allscenes).dtype)
+    return cloud_mask_3d, CF_adj_3d, QI_adj_3d, QL_adj_3d
+
+
+def orbit_seed(path, random_seed=139):
+    """
+    Random stream for an orbit file, reproducible for each orbit whatever order orbits are run in.
+    """
+    return np.random.default_rng([random_seed, zlib.crc32(os.path.basename(path).encode())])
+
+
+def _orbit_cloud_mask(path, random_seed, alpha):
+    #worker, reads an orbit and applies the cloud mask
+    orbit = read_orbit(path, {'Anc-SimTruth': ('cloud_fraction', 'qi', 'ql', 'pressure_profile', 'surface_pressure')})
+    return apply_cloud_mask(orbit['cloud_fraction'], orbit['qi'], orbit['ql'], orbit['pressure_profile'],
+                            orbit['surface_pressure'], alpha=alpha, rng=orbit_seed(path, random_seed))
+
+
+def apply_cloud_mask_orbits(paths, random_seed=139, alpha=3, nproc=None):
+    """
+    Apply the cloud mask calculation to many orbit files in parallel with a process pool.
+    Each orbit has its own random stream (orbit_seed), so results don't depend on nproc.
+
+    Parameters
+    ----------
+    paths : list
+        Orbit (*Truth*) files.
+    random_seed : int
+        Seed combined with each file name.
+    alpha : float
+        cloud decoupling parameter
+    nproc : int, optional
+        Number of processes, None for all cores.
+
+    Returns
+    -------
+    list
+        (cloud_mask_3d, CF_adj_3d, QI_adj_3d, QL_adj_3d) of each orbit, in the order of paths.
+    """
+    run = partial(_orbit_cloud_mask, random_seed=random_seed, alpha=alpha)
+    if nproc == 1:
+        return list(map(run, paths))
+    with ProcessPoolExecutor(max_workers=nproc) as pool:
+        return list(pool.map(run, paths))
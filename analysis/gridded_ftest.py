@@ -0,0 +1,184 @@
+import warnings
+import numpy as np
+import xarray as xr
+from scipy.stats import f
+from concurrent.futures import ProcessPoolExecutor
+
+
+def _batch_moments(x, axis=0):
+    #count, mean and sum of squared deviations of a batch, ignoring NaNs (lazy if x is a dask array)
+    n = np.sum(~np.isnan(x), axis=axis)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning) #all-NaN gridpoints
+        mean = np.nanmean(x, axis=axis)
+    m2 = np.nansum((x - np.expand_dims(mean, axis)) ** 2, axis=axis)
+    return n, mean, m2
+
+
+class RunningVariance:
+    """
+    Streaming per-gridpoint mean and variance, updated batch by batch along the sample dimension
+    and merged across workers with the Welford/Chan pairwise update, so the samples never have to be
+    held in memory at once. NaNs are skipped, so gridpoints may have different sample sizes.
+    """
+    def __init__(self):
+        self.n = self.mean = self.m2 = None
+
+    def _combine(self, n, mean, m2):
+        if self.n is None:
+            self.n, self.mean, self.m2 = np.asarray(n, dtype=np.int64), np.nan_to_num(mean), np.asarray(m2, dtype=float)
+            return self
+        ntot = self.n + n
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = np.nan_to_num(mean) - self.mean
+            frac = np.where(ntot > 0, n / ntot, 0.)
+            self.mean = self.mean + delta * frac
+            self.m2 = self.m2 + m2 + delta ** 2 * self.n * frac
+        self.n = ntot
+        return self
+
+    def update(self, x, axis=0):
+        """
+        Add a batch of samples (e.g. one chunk of time steps or members) along axis.
+        """
+        n, mean, m2 = _batch_moments(x, axis)
+        if hasattr(n, 'compute'): #dask array, the batch is computed chunk by chunk over the grid
+            import dask
+            n, mean, m2 = dask.compute(n, mean, m2)
+        return self._combine(n, mean, m2)
+
+    def merge(self, other):
+        """
+        Add the samples of another RunningVariance over the same grid.
+        """
+        if other.n is None:
+            return self
+        return self._combine(other.n, other.mean, other.m2)
+
+    def variance(self, ddof=1):
+        """
+        Sample variance at each gridpoint, NaN with ddof or fewer samples.
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.n > ddof, self.m2 / (self.n - ddof), np.nan)
+
+
+def _stream_moments(da, dim, start, stop, chunk):
+    #accumulate samples start:stop of da along dim, chunk by chunk
+    acc = RunningVariance()
+    for i in range(start, stop, chunk):
+        acc.update(da.isel({dim: slice(i, min(i + chunk, stop))}).data, axis=0)
+    return acc
+
+def variance_moments(da, dim, chunk=None, nproc=None):
+    """
+    Per-gridpoint sample counts, means and variances of a DataArray along a sample dimension, in one pass.
+
+    The samples are read chunk by chunk along dim, so a lazily loaded (file or dask backed) DataArray
+    is never fully in memory; with dask each chunk is computed in parallel over the grid. With nproc,
+    the sample dimension is split into nproc contiguous ranges accumulated in separate processes
+    (da must then be picklable, e.g. opened from files) and merged.
+
+    Parameters:
+        da (xarray.DataArray): Samples, with dim and any grid dimensions.
+        dim (str): Sample dimension (e.g. time or member).
+        chunk (int, optional): Samples per chunk, default the dask chunk size along dim or 128.
+        nproc (int, optional): Number of processes.
+
+    Returns:
+        RunningVariance: Accumulated moments with arrays over the other dimensions of da (in order).
+    """
+    da = da.transpose(dim, ...)
+    nsamp = da.sizes[dim]
+    if chunk is None:
+        chunk = da.chunksizes[dim][0] if da.chunks is not None else 128
+    if not nproc or nproc < 2:
+        return _stream_moments(da, dim, 0, nsamp, chunk)
+
+    edges = np.linspace(0, nsamp, min(nproc, nsamp) + 1).astype(int)
+    acc = RunningVariance()
+    with ProcessPoolExecutor(max_workers=nproc) as pool:
+        futures = [pool.submit(_stream_moments, da, dim, i0, i1, chunk) for i0, i1 in zip(edges[:-1], edges[1:])]
+        for fut in futures:
+            acc.merge(fut.result())
+    return acc
+
+
+def f_pvalue(F, dfn, dfd, alternative='greater'):
+    """
+    p-values of F statistics (arrays of any shape) for the variance-ratio test.
+
+    Parameters:
+        F (array-like): var_a / var_b.
+        dfn, dfd (array-like): Degrees of freedom of a and b (n - 1).
+        alternative (str, optional): 'greater' (Ha: var_a > var_b), 'less' or 'two-sided'.
+    """
+    if alternative == 'greater':
+        return f.sf(F, dfn, dfd)
+    elif alternative == 'less':
+        return f.cdf(F, dfn, dfd)
+    elif alternative == 'two-sided':
+        return np.minimum(2. * np.minimum(f.sf(F, dfn, dfd), f.cdf(F, dfn, dfd)), 1.)
+    raise ValueError("alternative must be 'greater', 'less' or 'two-sided'")
+
+def fdr(p_values, alpha=0.05):
+    """
+    False discovery rate control (Benjamini-Hochberg) over all gridpoints, as in Wilks (2016) for
+    fields of local tests. NaN p-values (e.g. gridpoints without data) are not counted as tests.
+
+    Parameters:
+        p_values (array-like or xarray.DataArray): p-values of every gridpoint.
+        alpha (float, optional): Control level of the FDR.
+
+    Returns:
+        Same type as p_values: True where the null hypothesis is rejected.
+    """
+    p = np.asarray(p_values, dtype=float)
+    valid = ~np.isnan(p)
+    ps = np.sort(p[valid])
+    below = np.flatnonzero(ps <= alpha * np.arange(1, len(ps) + 1) / max(len(ps), 1))
+    p_fdr = ps[below[-1]] if len(below) else -np.inf #largest p-value still rejected
+    reject = valid & (p <= p_fdr)
+    if isinstance(p_values, xr.DataArray):
+        return p_values.copy(data=reject)
+    return reject
+
+def f_test(a, b, dim, alternative='greater', alpha=None, chunk=None, nproc=None):
+    """
+    Variance-ratio F-test at every gridpoint between two samples, e.g. two ensembles or two climate periods.
+
+    Variances are unbiased (ddof=1) and accumulated in a single streaming pass over each input
+    (see variance_moments), so the fields never need to fit in memory. Sample sizes may differ between
+    a and b and between gridpoints (NaNs are skipped).
+
+    Parameters:
+        a, b (xarray.DataArray): Samples along dim, on the same grid.
+        dim (str): Sample dimension.
+        alternative (str, optional): 'greater' (Ha: var_a > var_b), 'less' or 'two-sided'.
+        alpha (float, optional): If given, also return which gridpoints are significant with FDR control at alpha.
+        chunk, nproc (int, optional): Passed to variance_moments.
+
+    Returns:
+        xarray.Dataset: var_a, var_b, F, dfn, dfd, p_value (and significant) over the grid.
+    """
+    grid = [d for d in a.dims if d != dim]
+    if set(grid) != set(d for d in b.dims if d != dim):
+        raise ValueError('a and b must have the same dimensions besides {}'.format(dim))
+    b = b.transpose(dim, *grid)
+    ma = variance_moments(a, dim, chunk=chunk, nproc=nproc)
+    mb = variance_moments(b, dim, chunk=chunk, nproc=nproc)
+
+    var_a, var_b = ma.variance(), mb.variance()
+    dfn, dfd = ma.n - 1, mb.n - 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        F = var_a / var_b
+    p = np.where((dfn > 0) & (dfd > 0), f_pvalue(F, np.maximum(dfn, 1), np.maximum(dfd, 1), alternative), np.nan)
+
+    template = a.isel({dim: 0}, drop=True).transpose(*grid)
+    out = xr.Dataset({name: template.copy(data=val) for name, val in
+                      [('var_a', var_a), ('var_b', var_b), ('F', F), ('dfn', dfn), ('dfd', dfd), ('p_value', p)]})
+    out.attrs['alternative'] = alternative
+    if alpha is not None:
+        out['significant'] = fdr(out.p_value, alpha)
+        out.attrs['fdr_alpha'] = alpha
+    return out
@@ -0,0 +1,121 @@
+import numpy as np
+
+
+def bin_index(edges, values):
+    """
+    Index of the bin of each value, -1 outside the bins. Like numpy.histogram the last bin includes
+    its right edge; edges may be increasing or decreasing (e.g. SH latitudes with y_bins *= -1).
+    """
+    edges = np.asarray(edges, dtype=float)
+    values = np.asarray(values, dtype=float)
+    nbin = len(edges) - 1
+    if edges[0] > edges[-1]: #decreasing, count from the other end
+        ind = bin_index(edges[::-1], values)
+        return np.where(ind >= 0, nbin - 1 - ind, -1)
+    ind = np.searchsorted(edges, values, side='right') - 1
+    ind[values == edges[-1]] = nbin - 1
+    ind[(ind < 0) | (ind >= nbin)] = -1 #also NaNs
+    return ind
+
+
+class GroupedHistogram:
+    """
+    Histograms of a variable for every gridbox of a 2D grid, as a (ngridbox, nbin) count array.
+
+    Every observation's gridbox and value bin are combined into one index, so all histograms are
+    counted in a single bincount. Counts can be updated file by file and merged across workers;
+    PDFs of groups of gridboxes (e.g. clusters) are sums of count rows, without rescanning observations.
+    Gridboxes are numbered in C order over (nx, ny), as binned_statistic_2d's statistic.
+
+    Parameters:
+        x_bins, y_bins (array-like): Gridbox edges in x (e.g. longitude) and y (e.g. latitude).
+        value_bins (array-like): Histogram bin edges of the variable.
+    """
+    def __init__(self, x_bins, y_bins, value_bins):
+        self.x_bins = np.asarray(x_bins, dtype=float)
+        self.y_bins = np.asarray(y_bins, dtype=float)
+        self.value_bins = np.asarray(value_bins, dtype=float)
+        self.shape = (len(self.x_bins) - 1, len(self.y_bins) - 1)
+        self.ngrid = self.shape[0] * self.shape[1]
+        self.nbin = len(self.value_bins) - 1
+        self.counts = np.zeros((self.ngrid, self.nbin), dtype=np.int64)
+
+    def gridbox(self, x, y):
+        """
+        Gridbox index of each observation, -1 outside the grid.
+        """
+        ix, iy = bin_index(self.x_bins, x), bin_index(self.y_bins, y)
+        return np.where((ix >= 0) & (iy >= 0), ix * self.shape[1] + iy, -1)
+
+    def update(self, x, y, values):
+        """
+        Add observations (e.g. those of one input file) to the counts.
+        """
+        g = self.gridbox(x, y)
+        v = bin_index(self.value_bins, values)
+        ok = (g >= 0) & (v >= 0)
+        self.counts += np.bincount(g[ok] * self.nbin + v[ok], minlength=self.ngrid * self.nbin).reshape(self.counts.shape)
+        return self
+
+    def merge(self, other):
+        """
+        Add the counts of another GroupedHistogram on the same grid and bins.
+        """
+        if not (np.array_equal(self.x_bins, other.x_bins) and np.array_equal(self.y_bins, other.y_bins)
+                and np.array_equal(self.value_bins, other.value_bins)):
+            raise ValueError('Can only merge histograms with the same grid and bins')
+        self.counts += other.counts
+        return self
+
+    @property
+    def totals(self):
+        """
+        Number of observations in each gridbox.
+        """
+        return self.counts.sum(axis=1)
+
+    def occupied(self):
+        """
+        Indices of gridboxes with observations (np.unique(binnumber) of binned_statistic_2d).
+        """
+        return np.flatnonzero(self.totals > 0)
+
+    def pdfs(self, gridboxes=None):
+        """
+        Normalized PDFs (as numpy.histogram's density=True) of each gridbox, NaN where there are no observations.
+        """
+        counts = self.counts if gridboxes is None else self.counts[gridboxes]
+        return _density(counts, self.value_bins)
+
+    def group_pdfs(self, labels, gridboxes=None, ngroup=None):
+        """
+        PDFs of groups of gridboxes, from summed count rows (same as a histogram of all their observations).
+
+        Parameters:
+            labels (numpy.ndarray): Group (e.g. cluster) of each gridbox in gridboxes, 0 to ngroup-1.
+            gridboxes (numpy.ndarray, optional): Gridbox of each label, default all gridboxes.
+            ngroup (int, optional): Number of groups, default labels.max()+1.
+
+        Returns:
+            numpy.ndarray: PDFs (ngroup, nbin).
+        """
+        labels = np.asarray(labels)
+        ngroup = labels.max() + 1 if ngroup is None else ngroup
+        counts = self.counts if gridboxes is None else self.counts[gridboxes]
+        summed = np.zeros((ngroup, self.nbin), dtype=np.int64)
+        np.add.at(summed, labels, counts)
+        return _density(summed, self.value_bins)
+
+    def to_grid(self, values, gridboxes=None, fill=np.nan):
+        """
+        Values per gridbox (e.g. cluster labels of gridboxes) as a (ny, nx) array for plotting.
+        """
+        out = np.full(self.ngrid, fill, dtype=float)
+        out[slice(None) if gridboxes is None else gridboxes] = values
+        return out.reshape(self.shape).T
+
+
+def _density(counts, bins):
+    #normalized like numpy.histogram(density=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return counts / counts.sum(axis=-1, keepdims=True) / np.diff(bins)
@@ -0,0 +1,111 @@
+import os
+import hashlib
+import numpy as np
+from scipy.cluster.hierarchy import linkage, cut_tree
+from scipy.spatial.distance import pdist
+from scipy.integrate import trapezoid
+
+
+def overlap_distance(pdfs, bins, block=256):
+    """
+    Condensed pairwise distance 1 - (overlapping area of two PDFs), the notebook's area() metric
+    (a percentage) as a fraction. Computed block by block of rows so only (block, n, nbin) is ever held.
+
+    Parameters:
+        pdfs (numpy.ndarray): PDFs (n, nbin), normalized over bins.
+        bins (numpy.ndarray): x of each PDF value (e.g. bin centers), as passed to area().
+        block (int, optional): Rows per block.
+
+    Returns:
+        numpy.ndarray: Distances in the condensed form of scipy.spatial.distance.pdist (n*(n-1)/2,).
+    """
+    pdfs = np.asarray(pdfs, dtype=float)
+    n = len(pdfs)
+    out = np.empty(n * (n - 1) // 2)
+    k = 0
+    for i0 in range(0, n - 1, block):
+        i1 = min(i0 + block, n - 1)
+        overlap = trapezoid(np.minimum(pdfs[i0:i1, None, :], pdfs[None, i0 + 1:, :]), bins, axis=-1)
+        for i in range(i0, i1): #row i of the condensed matrix: pairs (i, i+1..n-1)
+            row = overlap[i - i0, i - i0:]
+            out[k:k + len(row)] = 1. - row
+            k += len(row)
+    return out
+
+
+class LinkageTree:
+    """
+    Average-linkage clustering tree, built once and cut for any number of clusters.
+
+    Cutting the tree at k clusters gives the same partition as refitting
+    sklearn's AgglomerativeClustering(n_clusters=k, linkage='average') for each k (up to the cluster
+    numbering), always with exactly k clusters even where merge heights tie, but the pairwise
+    distances and merges are only computed once. With cache_dir the tree
+    and every cut are saved to disk, keyed by a hash of the input and metric, so reruns load them.
+
+    Parameters:
+        data (numpy.ndarray): Observations to cluster (n, nfeature), e.g. gridbox PDFs.
+        metric (str, optional): 'overlap' for overlap_distance, else any scipy pdist metric.
+        bins (numpy.ndarray, optional): x of the PDF values, needed for metric='overlap'.
+        cache_dir (str, optional): Directory to cache the tree and cuts in.
+    """
+    def __init__(self, data, metric='euclidean', bins=None, cache_dir=None):
+        self.data = np.ascontiguousarray(data, dtype=float)
+        self.metric = metric
+        self.bins = None if bins is None else np.asarray(bins, dtype=float)
+        if metric == 'overlap' and self.bins is None:
+            raise ValueError("metric='overlap' needs bins")
+        self.cache_dir = cache_dir
+        self.key = self._hash()
+        self._labels = {}
+        self.tree = self._load('tree')
+        if self.tree is None:
+            self.tree = self._build()
+            self._save('tree', self.tree)
+
+    def _hash(self):
+        h = hashlib.sha1()
+        h.update(str((self.data.shape, self.metric)).encode())
+        h.update(self.data.tobytes())
+        if self.bins is not None:
+            h.update(self.bins.tobytes())
+        return h.hexdigest()[:16]
+
+    def _path(self, name):
+        return os.path.join(self.cache_dir, 'linkage_{}_{}.npy'.format(self.key, name))
+
+    def _load(self, name):
+        if self.cache_dir is None or not os.path.exists(self._path(name)):
+            return None
+        return np.load(self._path(name))
+
+    def _save(self, name, arr):
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            np.save(self._path(name), arr)
+
+    def _build(self):
+        if self.metric == 'overlap':
+            dist = overlap_distance(self.data, self.bins)
+        else:
+            dist = pdist(self.data, metric=self.metric)
+        return linkage(dist, method='average')
+
+    def cut(self, n_clusters):
+        """
+        Cluster label (0 to n_clusters-1) of each observation when the tree is cut into n_clusters.
+        """
+        if n_clusters not in self._labels:
+            labels = self._load('cut{}'.format(n_clusters))
+            if labels is None:
+                #cut after the first n-k merges, unlike fcluster(maxclust) this never gives fewer clusters on ties
+                labels = cut_tree(self.tree, n_clusters=n_clusters)[:, 0]
+                self._save('cut{}'.format(n_clusters), labels)
+            self._labels[n_clusters] = labels
+        return self._labels[n_clusters]
+
+    def cuts(self, n_clusters):
+        """
+        Labels for each number of clusters in a list, as a dict {n_cluster: labels}.
+        """
+        return {k: self.cut(k) for k in n_clusters}
@@ -0,0 +1,148 @@
+import numpy as np
+import os
+import json
+import zlib
+import shutil
+import hashlib
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+from footprint_dataset import input_paths, open_fields, load_sigma_noise, n_patch_rows, iter_footprint_chunks
+from footprints import footprint_shape
+
+SHARD_FORMAT = 2 #bump when the way features are built changes, so older shards are rebuilt
+
+
+def shard_key(paths, noise_path, threshold, patch_size=3, overlap=2, seed=0, chunk_rows=16):
+    """
+    Hash identifying a feature shard by its inputs (path, size and modification time), parameters
+    and SHARD_FORMAT. chunk_rows is part of it since noise is drawn from one stream per chunk.
+    """
+    inputs = {k: [os.path.abspath(p), os.path.getsize(p), os.path.getmtime(p)]
+              for k, p in sorted(dict(paths, noise=noise_path).items())}
+    params = {'threshold': threshold, 'patch_size': patch_size, 'overlap': overlap, 'seed': seed,
+              'chunk_rows': chunk_rows, 'format': SHARD_FORMAT}
+    return hashlib.sha1(json.dumps([inputs, params], sort_keys=True).encode()).hexdigest()[:16]
+
+
+def build_shard(timestamp, outdir, threshold, patch_size=3, overlap=2, seed=0, root='.',
+                noise_path='./TIRS_ancillary/PREFIRE_SRF_v0.10.4_360_2021-03-28.nc', chunk_rows=16):
+    """
+    Build the footprint features and cloud flags for a single timestamp into .npy files with a
+    JSON manifest, or reuse them if a shard with the same inputs and parameters already exists.
+    Features are written chunk by chunk into a memory-mapped file, so memory is bounded by chunk_rows.
+
+    Parameters:
+        timestamp (str): Timestamp of simulation, e.g. '03UTC'.
+        outdir (str): Directory holding all shards, each in its own subdirectory named by its key.
+        threshold (float): twp threshold for what we consider clear or cloudy.
+        patch_size (int, optional): Footprint size in grid cells.
+        overlap (int, optional): Overlap from previous footprint in lon direction.
+        seed (int, optional): Seed for noise injection.
+        root (str, optional): Directory containing the simulation folders.
+        noise_path (str, optional): File with noise std for each channel.
+        chunk_rows (int, optional): Footprint rows read per chunk.
+
+    Returns:
+        str: Path of the shard's manifest.
+    """
+    paths = input_paths(timestamp, root)
+    key = shard_key(paths, noise_path, threshold, patch_size, overlap, seed, chunk_rows)
+    sharddir = os.path.join(outdir, key)
+    manifest = os.path.join(sharddir, 'manifest.json')
+    if os.path.exists(manifest): #already built, nothing to do
+        return manifest
+
+    fields = open_fields(timestamp, paths=paths)
+    sigma_noise = load_sigma_noise(noise_path)
+    nray = n_patch_rows(fields, patch_size)*footprint_shape(fields['rad'].shape, patch_size, overlap)[1]
+    nfeature = len(sigma_noise[2:]) + 2
+
+    #write into a temporary directory and rename when complete, so a crashed build is never reused
+    tmpdir = sharddir + '.tmp{}'.format(os.getpid())
+    os.makedirs(tmpdir, exist_ok=True)
+    footprints = np.lib.format.open_memmap(os.path.join(tmpdir, 'footprints.npy'), mode='w+',
+                                           dtype=np.float32, shape=(nray, nfeature))
+    cloudy = np.lib.format.open_memmap(os.path.join(tmpdir, 'cloudy.npy'), mode='w+',
+                                       dtype=np.uint8, shape=(nray,))
+    i = 0
+    #noise streams differ between timestamps but are reproducible for each
+    for k, features, cloud in iter_footprint_chunks(fields, sigma_noise, patch_size=patch_size, overlap=overlap,
+                                                    chunk_rows=chunk_rows, seed=zlib.crc32('{}-{}'.format(seed, timestamp).encode())):
+        footprints[i:i + len(cloud)] = features
+        cloudy[i:i + len(cloud)] = cloud > threshold
+        i += len(cloud)
+    footprints.flush()
+    cloudy.flush()
+    del footprints, cloudy
+
+    with open(os.path.join(tmpdir, 'manifest.json'), 'w') as fp:
+        json.dump({'key': key, 'timestamp': timestamp, 'inputs': paths, 'noise': noise_path,
+                   'threshold': threshold, 'patch_size': patch_size, 'overlap': overlap, 'seed': seed,
+                   'chunk_rows': chunk_rows, 'format': SHARD_FORMAT, 'nray': nray, 'nfeature': nfeature,
+                   'footprints': 'footprints.npy', 'cloudy': 'cloudy.npy'}, fp, indent=1)
+    try:
+        os.rename(tmpdir, sharddir)
+    except OSError: #another job built the same shard meanwhile
+        shutil.rmtree(tmpdir)
+    return manifest
+
+
+def build_shards(timestamps, outdir, threshold, nproc=None, **kwargs):
+    """
+    Build (or reuse) shards for many timestamps in parallel with a process pool.
+    Keyword arguments are passed on to build_shard.
+
+    Returns:
+        list: Manifest paths, in the order of timestamps.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    build = partial(build_shard, outdir=outdir, threshold=threshold, **kwargs)
+    if nproc == 1:
+        return list(map(build, timestamps))
+    with ProcessPoolExecutor(max_workers=nproc) as pool:
+        return list(pool.map(build, timestamps))
+
+
+class ShardedArray:
+    """
+    Read-only row-indexable view over several arrays (e.g. memory-mapped shards) as if concatenated.
+    """
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.offsets = np.cumsum([0] + [len(a) for a in arrays])
+        self.shape = (self.offsets[-1],) + arrays[0].shape[1:]
+        self.dtype = arrays[0].dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, ind):
+        ind = np.asarray(ind)
+        out = np.empty(ind.shape + self.shape[1:], dtype=self.dtype)
+        which = np.searchsorted(self.offsets, ind, side='right') - 1
+        for n in np.unique(which):
+            sel = which == n
+            out[sel] = self.arrays[n][ind[sel] - self.offsets[n]]
+        return out
+
+
+def load_shards(manifests, window=3):
+    """
+    Memory-map feature shards for training with triplet_sampler.TripletSequence.
+
+    Returns:
+        ShardedArray: footprints (nray, nfeature) float32, read from disk only when gathered.
+        numpy.ndarray: cloudy (nray,) uint8, 1 if footprint's twp > threshold.
+        numpy.ndarray: starts, index of first footprint of each valid triplet (never spanning two shards).
+    """
+    footprints, cloudy = [], []
+    for manifest in manifests:
+        with open(manifest) as fp:
+            meta = json.load(fp)
+        sharddir = os.path.dirname(manifest)
+        footprints.append(np.load(os.path.join(sharddir, meta['footprints']), mmap_mode='r'))
+        cloudy.append(np.load(os.path.join(sharddir, meta['cloudy'])))
+    footprints = ShardedArray(footprints)
+    starts = np.concatenate([np.arange(o, o + len(c) - (window - 1)) for o, c in zip(footprints.offsets, cloudy)])
+    return footprints, np.concatenate(cloudy), starts
@@ -0,0 +1,228 @@
+import numpy as np
+import glob
+import xarray as xr
+from numpy.lib import stride_tricks
+
+from footprints import footprint_mean, footprint_column_mean
+
+
+def patch_func(arr,patch_size,overlap, threed=False):
+    """
+    Strided view of overlapping footprints on a regular grid (no copy).
+    Reducing this view re-reads each pixel several times, prefer footprints.footprint_mean for averages.
+    Footprints do not overlap in the first (lat) dimension and overlap by `overlap` in the second (lon).
+    """
+    h,w = arr.shape[0],arr.shape[1]
+    if threed:
+        shape = ((h - patch_size)//(patch_size) + 1 , (w - patch_size)//(patch_size-overlap) + 1, patch_size, patch_size,  arr.shape[2])
+        r,c,z = arr.strides
+        strides = ((patch_size)*r,(patch_size-overlap)*c,r,c,z)
+    else:
+        shape = ( (h - patch_size)//(patch_size) + 1 , (w - patch_size)//(patch_size-overlap) + 1, patch_size, patch_size)
+        r,c = arr.strides
+        strides = ((patch_size)*r,(patch_size-overlap)*c,r,c)
+    blocks=stride_tricks.as_strided(arr, shape=shape, strides=strides)
+    return blocks
+
+
+def rolling_window(a, window_size):
+    shape = (a.shape[0] - window_size + 1, window_size) + a.shape[1:]
+    strides = (a.strides[0],) + a.strides
+    return np.lib.stride_tricks.as_strided(a, shape=shape, strides=strides)
+
+
+############
+#INPUTS
+def input_paths(timestamp, root='.'):
+    """
+    Paths of the input files for a single timestamp.
+    """
+    return {'rad': '{}/TIRS_SRF_v0.10.4/{}/TIRS_radiance_20160801_{}.h5'.format(root, timestamp, timestamp),
+            'lwp': '{}/GFDL_sim_wps/GFDL_lwp_{}.nc4'.format(root, timestamp),
+            'iwp': '{}/GFDL_sim_wps/GFDL_iwp_{}.nc4'.format(root, timestamp),
+            'ts': glob.glob('{}/GFDL_fields_3km/ts/ts*{}*'.format(root, timestamp))[0],
+            'pwv': '{}/GFDL_data/20160801_{}_GFDL_pwv.nc'.format(root, timestamp)}
+
+
+def open_fields(timestamp, root='.', paths=None):
+    """
+    Lazily open all fields needed to build footprint features for a single timestamp.
+    Nothing is read from disk until a latitude chunk is selected.
+
+    Parameters:
+        timestamp (str): Timestamp of simulation, e.g. '03UTC'.
+        root (str, optional): Directory containing the simulation folders.
+        paths (dict, optional): Input paths, if already found with input_paths.
+
+    Returns:
+        dict: DataArrays 'rad' (nlat, nlon, nchannel), 'ts' (K), 'pwv' and 'twp' (lwp+iwp), each (nlat, nlon).
+    """
+    if paths is None:
+        paths = input_paths(timestamp, root)
+    rad = xr.open_dataset(paths['rad']).rad
+    lwp = xr.open_dataset(paths['lwp']).lwp
+    iwp = xr.open_dataset(paths['iwp']).iwp
+    ts = xr.open_dataset(paths['ts']).ts
+    pwv = xr.open_dataset(paths['pwv']).pwv[3]
+    return {'rad': rad, 'ts': ts, 'pwv': pwv, 'twp': lwp + iwp}
+
+
+def load_sigma_noise(path='./TIRS_ancillary/PREFIRE_SRF_v0.10.4_360_2021-03-28.nc'):
+    """
+    The std of measurement noise for each channel that isn't masked by bad detectors (63 -> 54).
+    """
+    noise_xr = xr.open_dataset(path)
+    sigma_noise = np.array(noise_xr.NEDR)
+    #0 or 1 filters are masked
+    clear_channel = np.where(noise_xr.filter_number > 1)
+    return sigma_noise[clear_channel[0]][:,0]
+
+
+def n_patch_rows(fields, patch_size=3):
+    """
+    Number of (non-overlapping) rows of footprints in the latitude direction.
+    """
+    return (fields['rad'].shape[0] - patch_size)//patch_size + 1
+
+
+############
+#FEATURES
+def chunk_features(fields, r0, r1, sigma_noise, patch_size=3, overlap=2, rng=None):
+    """
+    Build noisy footprint features and cloud amounts for footprint rows r0:r1.
+
+    Rows are flattened with longitude varying fastest, identical to the ordering of
+    np.swapaxes(patches,0,1).reshape(..., order='F') on the full grid, so consecutive chunks
+    can simply be appended to one another.
+
+    Parameters:
+        fields (dict): Lazy fields from open_fields.
+        r0, r1 (int): Range of footprint rows to build.
+        sigma_noise (numpy.ndarray): Noise std for each channel (from load_sigma_noise),
+            None for no noise injection (e.g. real observations).
+        patch_size (int, optional): Footprint size in grid cells.
+        overlap (int, optional): Overlap from previous footprint in lon direction.
+        rng (numpy.random.Generator, optional): Random stream for noise injection.
+
+    Returns:
+        numpy.ndarray: features (nray, nfeature), noisy radiances followed by ts and pwv.
+        numpy.ndarray: cloud (nray,), twp averaged over the lat direction of each footprint's last column
+            (None if fields has no 'twp').
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    lats = slice(r0*patch_size, r1*patch_size) #only read lat rows belonging to these footprints
+
+    #we remove the first two channels since they're SW and we can't model them correctly right now
+    #footprint means are float32 with noise applied in place, 1K noise for ts, 10% relative noise for cwv
+    noisy = sigma_noise is not None
+    radiances = footprint_mean(fields['rad'][lats][...,2:], patch_size, overlap,
+                               noise=sigma_noise[2:] if noisy else None, rng=rng)
+    ts = footprint_mean(np.array(fields['ts'][lats]) - 273.15, patch_size, overlap, noise=1. if noisy else None, rng=rng)
+    pwv = footprint_mean(np.array(fields['pwv'][lats])*1000., patch_size, overlap, rel_noise=0.1 if noisy else None, rng=rng)
+
+    features = np.concatenate((radiances.reshape((-1,radiances.shape[-1])), ts.reshape((-1,1)), pwv.reshape((-1,1))), axis=1)
+    cloud = None
+    if 'twp' in fields:
+        cloud = footprint_column_mean(fields['twp'][lats], patch_size, overlap, dtype=np.float64).reshape(-1)
+    return features, cloud
+
+
+def iter_footprint_chunks(fields, sigma_noise, patch_size=3, overlap=2, chunk_rows=16, seed=0):
+    """
+    Generator over latitude chunks of footprint features, reading only one chunk at a time.
+    Noise for each chunk is drawn from its own seeded stream, so repeated passes are identical.
+
+    Yields:
+        tuple: (chunk index, features, cloud) as returned by chunk_features.
+    """
+    nrows = n_patch_rows(fields, patch_size)
+    for k, r0 in enumerate(range(0, nrows, chunk_rows)):
+        rng = np.random.default_rng([seed, k])
+        features, cloud = chunk_features(fields, r0, min(r0 + chunk_rows, nrows), sigma_noise,
+                                         patch_size=patch_size, overlap=overlap, rng=rng)
+        yield k, features, cloud
+
+
+############
+#TRIPLETS
+def iter_triplet_batches(fields, sigma_noise, threshold, batch_size=10000, patch_size=3, overlap=2,
+                         chunk_rows=16, seed=0, val_fraction=0.25, subset=None):
+    """
+    Lazily generate batches of footprint triplets and cloud labels.
+
+    Triplets roll along the flattened footprints exactly as rolling_window on the full grid does;
+    the last footprints of each chunk are carried into the next so no triplet is lost at chunk edges.
+    Triplets are shuffled within each chunk and assigned to train/validation with a seeded mask,
+    so a 'train' and a 'validation' generator with the same seed partition the same data.
+
+    Parameters:
+        fields (dict): Lazy fields from open_fields.
+        sigma_noise (numpy.ndarray): Noise std for each channel.
+        threshold (float): twp threshold for what we consider clear or cloudy.
+        batch_size (int, optional): Number of triplets per batch.
+        chunk_rows (int, optional): Footprint rows read per chunk, bounds peak memory.
+        seed (int, optional): Seed for noise, shuffling and the validation split.
+        val_fraction (float, optional): Fraction of triplets held out for validation.
+        subset (str, optional): 'train', 'validation' or None for all triplets.
+
+    Yields:
+        tuple: ((footprint1, footprint2, footprint3), labels) with shapes (nbatch, nfeature) and (nbatch,).
+    """
+    window = patch_size
+    carry_f = carry_c = None
+    for k, features, cloud in iter_footprint_chunks(fields, sigma_noise, patch_size=patch_size, overlap=overlap,
+                                                    chunk_rows=chunk_rows, seed=seed):
+        if carry_f is not None:
+            features = np.concatenate((carry_f, features))
+            cloud = np.concatenate((carry_c, cloud))
+        carry_f, carry_c = features[1-window:], cloud[1-window:]
+
+        triplets = rolling_window(features, window)
+        #if twp>threshold, make it 'cloud'(1) otherwise 'clear' (0)
+        labels = (rolling_window(cloud, window)[:,window-1] > threshold).astype(np.float32)
+
+        rng = np.random.default_rng([seed, k, 1])
+        order = rng.permutation(len(labels))
+        if subset is not None:
+            is_val = rng.random(len(labels)) < val_fraction
+            order = order[is_val[order] == (subset == 'validation')]
+
+        for i in range(0, len(order), batch_size):
+            ind = order[i:i + batch_size]
+            yield tuple(triplets[ind, j] for j in range(window)), labels[ind]
+
+
+def count_labels(fields, threshold, patch_size=3, overlap=2, chunk_rows=64):
+    """
+    Count clear and cloudy triplets with a chunked pass over twp only (for class weights).
+
+    Returns:
+        tuple: (clear count, cloud count)
+    """
+    nrows = n_patch_rows(fields, patch_size)
+    total_ct = cloud_ct = 0
+    for r0 in range(0, nrows, chunk_rows):
+        lats = slice(r0*patch_size, min(r0 + chunk_rows, nrows)*patch_size)
+        cloud = footprint_column_mean(fields['twp'][lats], patch_size, overlap, dtype=np.float64).reshape(-1)
+        if r0 == 0: #label of each triplet is that of its last footprint, the first footprints never label one
+            cloud = cloud[patch_size-1:]
+        total_ct += len(cloud)
+        cloud_ct += np.count_nonzero(cloud > threshold)
+    return total_ct - cloud_ct, cloud_ct
+
+
+def make_tf_dataset(fields, sigma_noise, threshold, batch_size=10000, subset=None, prefetch=2, **kwargs):
+    """
+    Wrap iter_triplet_batches as a tf.data.Dataset suitable for model.fit with three footprint inputs.
+    Keyword arguments are passed on to iter_triplet_batches.
+    """
+    import tensorflow as tf #only needed for this wrapper
+
+    nfeature = len(sigma_noise[2:]) + 2
+    footprint = tf.TensorSpec(shape=(None, nfeature), dtype=tf.float32)
+    signature = ((footprint, footprint, footprint), tf.TensorSpec(shape=(None,), dtype=tf.float32))
+    ds = tf.data.Dataset.from_generator(
+        lambda: iter_triplet_batches(fields, sigma_noise, threshold, batch_size=batch_size, subset=subset, **kwargs),
+        output_signature=signature)
+    return ds.prefetch(prefetch)
@@ -0,0 +1,73 @@
+import numpy as np
+
+
+def footprint_shape(shape, patch_size=3, overlap=2):
+    """
+    Number of footprint rows (lat) and columns (lon) that fit on a grid, same as patch_func.
+    """
+    h,w = shape[0],shape[1]
+    return (h - patch_size)//patch_size + 1, (w - patch_size)//(patch_size - overlap) + 1
+
+
+def footprint_mean(arr, patch_size=3, overlap=2, dtype=np.float32, noise=None, rel_noise=None, rng=None):
+    """
+    Mean over every overlapping footprint using cumulative sums (an integral image).
+
+    Footprints don't overlap in the lat direction, so rows are block-summed; along lon the
+    cumulative sum is differenced at each footprint's edges. Each pixel is read once and all
+    channels are done together, so the cost is O(pixels) for any patch_size/overlap.
+    Equivalent to patch_func(arr, patch_size, overlap, threed=arr.ndim==3).mean(axis=(2,3)).
+
+    Parameters:
+        arr (array-like): Field with shape (nlat, nlon) or (nlat, nlon, nchannel).
+        patch_size (int, optional): Footprint size in grid cells.
+        overlap (int, optional): Overlap from previous footprint in lon direction.
+        dtype (numpy.dtype, optional): Output dtype, sums are always accumulated in float64.
+        noise (float or array-like, optional): Std of gaussian noise added to each footprint (per channel).
+        rel_noise (float, optional): Std of gaussian noise relative to each footprint mean.
+        rng (numpy.random.Generator, optional): Random stream for noise injection.
+
+    Returns:
+        numpy.ndarray: Footprint means with shape (nrow, ncol) or (nrow, ncol, nchannel).
+    """
+    arr = np.asarray(arr)
+    R, Q = footprint_shape(arr.shape, patch_size, overlap)
+    step = patch_size - overlap
+
+    #sum non-overlapping blocks of rows, then integral image along lon (zero padded at the start)
+    rows = arr[:R*patch_size].reshape((R, patch_size) + arr.shape[1:]).sum(axis=1, dtype=np.float64)
+    csum = np.zeros((R, rows.shape[1] + 1) + arr.shape[2:])
+    np.cumsum(rows, axis=1, out=csum[:, 1:])
+    c0 = np.arange(Q)*step
+    out = ((csum[:, c0 + patch_size] - csum[:, c0]) / patch_size**2).astype(dtype)
+
+    if noise is not None or rel_noise is not None:
+        if rng is None:
+            rng = np.random.default_rng()
+        scale = 0.
+        if noise is not None:
+            scale = scale + np.asarray(noise, dtype=dtype)
+        if rel_noise is not None:
+            scale = scale + rel_noise*np.abs(out)
+        out += (rng.standard_normal(out.shape)*scale).astype(dtype)
+    return out
+
+
+def footprint_column_mean(arr, patch_size=3, overlap=2, col=None, dtype=np.float32):
+    """
+    Mean over the lat direction of a single column of every footprint, used for cloud labels.
+    Equivalent to patch_func(arr, patch_size, overlap).mean(axis=2)[:,:,col].
+
+    Parameters:
+        arr (array-like): Field with shape (nlat, nlon).
+        col (int, optional): Column within the footprint, defaults to the last (patch_size-1).
+
+    Returns:
+        numpy.ndarray: Column means with shape (nrow, ncol).
+    """
+    arr = np.asarray(arr)
+    if col is None:
+        col = patch_size - 1
+    R, Q = footprint_shape(arr.shape, patch_size, overlap)
+    rows = arr[:R*patch_size].reshape((R, patch_size) + arr.shape[1:]).mean(axis=1, dtype=np.float64)
+    return rows[:, col + np.arange(Q)*(patch_size - overlap)].astype(dtype)
@@ -0,0 +1,169 @@
+import numpy as np
+import time
+import queue
+import argparse
+import threading
+import xarray as xr
+
+from footprint_dataset import input_paths, load_sigma_noise, n_patch_rows, chunk_features, rolling_window
+from footprints import footprint_shape
+
+
+def open_inputs(rad, ts, pwv, pwv_index=3):
+    """
+    Lazily open the fields used as features (no cloud fields needed for inference).
+
+    Parameters:
+        rad, ts, pwv (str): Paths of the radiance (nlat, nlon, nchannel), surface temperature (K) and
+            column water vapor files.
+        pwv_index (int, optional): Time index of pwv, if the file has more than one.
+
+    Returns:
+        dict: DataArrays 'rad', 'ts' and 'pwv'.
+    """
+    pwv = xr.open_dataset(pwv).pwv
+    if pwv.ndim == 3:
+        pwv = pwv[pwv_index]
+    return {'rad': xr.open_dataset(rad).rad, 'ts': xr.open_dataset(ts).ts, 'pwv': pwv}
+
+
+def footprint_coords(fields, patch_size=3, overlap=2):
+    """
+    Centre coordinates of each footprint row and column, from the radiance grid's coordinates.
+    """
+    rad = fields['rad']
+    R, Q = footprint_shape(rad.shape, patch_size, overlap)
+    coords = {}
+    for dim, n, step in zip(rad.dims[:2], (R, Q), (patch_size, patch_size - overlap)):
+        if dim in rad.coords:
+            c = np.asarray(rad[dim])
+            coords[dim] = np.array([c[i*step:i*step + patch_size].mean() for i in range(n)])
+    return coords
+
+
+def _read_chunks(fields, sigma_noise, patch_size, overlap, chunk_rows, seed, out):
+    #reader thread, builds footprint features so I/O overlaps with model.predict
+    nrows = n_patch_rows(fields, patch_size)
+    try:
+        for k, r0 in enumerate(range(0, nrows, chunk_rows)):
+            t0 = time.perf_counter()
+            features, _ = chunk_features(fields, r0, min(r0 + chunk_rows, nrows), sigma_noise, patch_size=patch_size,
+                                         overlap=overlap, rng=np.random.default_rng([seed, k]))
+            out.put((features, time.perf_counter() - t0))
+    except Exception as e: #pass on to the main thread
+        out.put(e)
+    out.put(None)
+
+
+def predict_swath(model, fields, sigma_noise=None, patch_size=3, overlap=2, chunk_rows=16, batch_size=100000,
+                  prefetch=2, seed=0, verbose=True):
+    """
+    Apply an overlapping cloud mask model to a full swath/global field, streamed in latitude chunks.
+
+    Footprints and triplets are built exactly as for training; the prediction of each triplet is
+    assigned to its last footprint, as was its label. A reader thread builds the next chunks while
+    the current one is being predicted.
+
+    Parameters:
+        model (tf.keras.Model): Model with three footprint inputs.
+        fields (dict): Lazy fields 'rad', 'ts' and 'pwv'.
+        sigma_noise (numpy.ndarray, optional): Noise std for each channel, only for simulated inputs.
+        chunk_rows (int, optional): Footprint rows read per chunk.
+        batch_size (int, optional): Batch size for model.predict.
+        prefetch (int, optional): Number of chunks the reader may get ahead.
+        seed (int, optional): Seed for noise injection.
+        verbose (bool, optional): Print throughput after each chunk.
+
+    Returns:
+        numpy.ndarray: Probability of cloud on the footprint grid (nrow, ncol), NaN where no triplet ends.
+        dict: Throughput report.
+    """
+    window = patch_size
+    R, Q = footprint_shape(fields['rad'].shape, patch_size, overlap)
+    prob = np.full(R*Q, np.nan, dtype=np.float32)
+
+    chunks = queue.Queue(maxsize=prefetch)
+    reader = threading.Thread(target=_read_chunks, args=(fields, sigma_noise, patch_size, overlap, chunk_rows, seed, chunks),
+                              daemon=True)
+    t_start = time.perf_counter()
+    reader.start()
+
+    carry = None
+    i = 0 #number of footprints seen so far
+    t_read = t_pred = 0.
+    while True:
+        item = chunks.get()
+        if item is None:
+            break
+        if isinstance(item, Exception):
+            raise item
+        features, dt = item
+        t_read += dt
+        nnew = len(features)
+        if carry is not None:
+            features = np.concatenate((carry, features))
+        carry = features[1-window:]
+
+        t0 = time.perf_counter()
+        triplets = rolling_window(features, window)
+        pred = model.predict([triplets[:,j] for j in range(window)], batch_size=batch_size, verbose=0)
+        t_pred += time.perf_counter() - t0
+
+        prob[i + nnew - len(pred):i + nnew] = pred[:,1] #probability of cloud, assigned to each triplet's last footprint
+        i += nnew
+        if verbose:
+            print('{}/{} footprints, {:.0f} footprints/s'.format(i, R*Q, i/(time.perf_counter() - t_start)))
+    reader.join()
+
+    t_total = time.perf_counter() - t_start
+    report = {'footprints': R*Q, 'seconds': t_total, 'footprints_per_s': R*Q/t_total,
+              'read_seconds': t_read, 'predict_seconds': t_pred}
+    return prob.reshape((R, Q)), report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Apply the overlapping cloud mask model to full swaths.')
+    parser.add_argument('output', help='netCDF file to write the cloud probability mask to')
+    parser.add_argument('--model', default='./NN_models/PREFIRE_cloudmask/modelvariable_noise/overlapping_modelvar')
+    parser.add_argument('--timestamp', help='use the simulation inputs of this timestamp (as in training)')
+    parser.add_argument('--root', default='.', help='directory containing the simulation folders')
+    parser.add_argument('--rad', help='radiance file (overrides --timestamp)')
+    parser.add_argument('--ts', help='surface temperature file (overrides --timestamp)')
+    parser.add_argument('--pwv', help='column water vapor file (overrides --timestamp)')
+    parser.add_argument('--pwv-index', type=int, default=3, help='time index of pwv')
+    parser.add_argument('--noise', help='SRF file, add measurement noise to simulated radiances as in training')
+    parser.add_argument('--patch-size', type=int, default=3)
+    parser.add_argument('--overlap', type=int, default=2)
+    parser.add_argument('--chunk-rows', type=int, default=16)
+    parser.add_argument('--batch-size', type=int, default=100000)
+    args = parser.parse_args()
+
+    paths = input_paths(args.timestamp, args.root) if args.timestamp else {}
+    paths.update({k: getattr(args, k) for k in ('rad', 'ts', 'pwv') if getattr(args, k)})
+    missing = [k for k in ('rad', 'ts', 'pwv') if k not in paths]
+    if missing:
+        parser.error('missing input file(s) {}: give --timestamp or all of --rad, --ts and --pwv'.format(
+            ', '.join('--' + k for k in missing)))
+    fields = open_inputs(paths['rad'], paths['ts'], paths['pwv'], pwv_index=args.pwv_index)
+    sigma_noise = load_sigma_noise(args.noise) if args.noise else None
+
+    import tensorflow as tf #slow import, only once arguments are valid
+    model = tf.keras.models.load_model(args.model)
+
+    prob, report = predict_swath(model, fields, sigma_noise=sigma_noise, patch_size=args.patch_size, overlap=args.overlap,
+                                 chunk_rows=args.chunk_rows, batch_size=args.batch_size)
+
+    coords = footprint_coords(fields, args.patch_size, args.overlap)
+    dims = [d if d in coords else 'footprint_{}'.format(d) for d in fields['rad'].dims[:2]]
+    ds = xr.Dataset({'cloud_prob': (dims, prob, {'long_name': 'probability of cloud',
+                                                 'description': 'prediction of the triplet ending at this footprint'})},
+                    coords=coords)
+    ds.attrs.update(model=args.model, patch_size=args.patch_size, overlap=args.overlap)
+    ds.to_netcdf(args.output)
+
+    print('Scored {footprints} footprints in {seconds:.1f}s ({footprints_per_s:.0f} footprints/s), '
+          '{read_seconds:.1f}s reading, {predict_seconds:.1f}s predicting'.format(**report))
+
+
+if __name__ == '__main__':
+    main()
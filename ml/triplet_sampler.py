@@ -0,0 +1,71 @@
+import numpy as np
+import tensorflow as tf
+
+
+def split_indices(starts, val_fraction=0.25, seed=None):
+    """
+    Shuffle triplet indices and hold out the last fraction for validation (as keras' validation_split).
+
+    Parameters:
+        starts (numpy.ndarray): First footprint index of each valid triplet.
+        val_fraction (float, optional): Fraction of triplets for the validation set.
+        seed (int, optional): Seed for the shuffle.
+
+    Returns:
+        tuple: (train, validation) int index arrays.
+    """
+    starts = np.random.default_rng(seed).permutation(starts)
+    n_val = int(len(starts)*val_fraction)
+    return starts[:len(starts) - n_val], starts[len(starts) - n_val:]
+
+
+def class_weights(cloudy, starts, window=3):
+    """
+    Weight our classes so that clear and cloud predictions are STATISTICALLY equally important.
+    The label of a triplet is that of its last footprint.
+    """
+    cloud_ct = np.count_nonzero(cloudy[starts + window - 1])
+    clear_ct = len(starts) - cloud_ct
+    total_ct = clear_ct + cloud_ct
+    return {0: (1. / clear_ct)*(total_ct)/2.0, 1: (1. / cloud_ct)*(total_ct)/2.0}
+
+
+class TripletSequence(tf.keras.utils.Sequence):
+    """
+    Batches of footprint triplets gathered on the fly from a single compact footprint array.
+
+    Only an int index array is shuffled and split; each batch gathers its three neighbouring
+    footprints (i, i+1, i+2) when requested, so footprints are stored once. The footprint
+    array may be a numpy memmap or feature_shards.ShardedArray, indices within a batch are sorted to keep reads local.
+
+    Parameters:
+        footprints (numpy.ndarray): Footprint features (nray, nfeature).
+        cloudy (numpy.ndarray): Label of each footprint (nray,).
+        starts (numpy.ndarray): First footprint index of each triplet in this set.
+        batch_size (int, optional): Number of triplets per batch.
+        shuffle (bool, optional): Reshuffle triplets at the end of every epoch.
+        window (int, optional): Number of footprints with common overlap.
+        seed (int, optional): Seed for reshuffling.
+    """
+    def __init__(self, footprints, cloudy, starts, batch_size=10000, shuffle=True, window=3, seed=None):
+        super().__init__()
+        self.footprints = footprints
+        self.cloudy = cloudy
+        self.starts = np.array(starts)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.window = window
+        self.rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        return int(np.ceil(len(self.starts) / self.batch_size))
+
+    def __getitem__(self, i):
+        ind = np.sort(self.starts[i*self.batch_size:(i + 1)*self.batch_size])
+        x = [np.asarray(self.footprints[ind + j]) for j in range(self.window)]
+        y = np.asarray(self.cloudy[ind + self.window - 1], dtype=np.float32)
+        return x, y
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.rng.shuffle(self.starts)
@@ -1,6 +1,10 @@
+import os
 import numpy as np
+import xarray as xr
 import matplotlib.pyplot as plt
-from scipy import stats
+from scipy import stats, optimize, signal
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 
 
@@ -14,17 +18,75 @@ def first_deriv_pdf(x, mu, s):
     Evaluate the first derivative of a Gaussian Kernel Density Estimation (KDE) at x.
 
     Parameters:
-        x (float): point at which to evaluate the first derivative.
+        x (float or array-like): point(s) at which to evaluate the first derivative.
         mu (array-like): Points being used to fit KDE, each fit with a normal distribution
         s (float): KDE bandwidth (smoothing)
 
     Returns:
-        float: Value of the first derivative at point x.
+        float or numpy.ndarray: Value of the first derivative at point(s) x, same shape as x.
     """
     N = len(mu)
     fact = -(1 / (((2 * np.pi) ** 0.5) * N * s ** 3.))
-    xmm = x - mu
-    return fact * (np.exp(-((xmm) ** 2.) / (2 * s ** 2.)) * xmm).sum(axis=0)
+    xmm = np.asarray(x)[..., None] - np.asarray(mu) # broadcast each x against all samples
+    return fact * (np.exp(-((xmm) ** 2.) / (2 * s ** 2.)) * xmm).sum(axis=-1)
+
+##### Binned/FFT approximation of the first derivative of Gaussian KDE PDF
+def binned_kde_deriv(mu, s, eps=1e-4):
+    """
+    Evaluate the first derivative of a Gaussian KDE on a regular grid by linearly binning the
+    samples and convolving the bin counts with the derivative-of-Gaussian kernel via FFT.
+
+    Cost is O(N + G log G) for N samples and G grid points, rather than O(N) per evaluation point.
+    The grid spacing is s*sqrt(eps) and the kernel is truncated where it falls below eps of its
+    peak, so the error relative to first_deriv_pdf is roughly eps (smaller eps, larger grid).
+
+    Parameters:
+        mu (array-like): Points being used to fit KDE, each fit with a normal distribution
+        s (float): KDE bandwidth (smoothing)
+        eps (float, optional): Accuracy bound controlling bin width and kernel truncation.
+
+    Returns:
+        tuple: (grid, dens) arrays, pass as fargs to binned_deriv_pdf.
+    """
+    mu = np.asarray(mu, dtype=float).ravel()
+    N = len(mu)
+    delta = s * eps ** 0.5 # bin width
+    K = int(np.ceil(s * (-2 * np.log(eps)) ** 0.5 / delta)) # kernel half-width in bins
+
+    # grid padded by the kernel half-width on each side, so the derivative reaches ~0 at the ends
+    lo = mu.min() - K * delta
+    M = int(np.ceil((mu.max() - lo) / delta)) + K + 2
+    grid = lo + delta * np.arange(M)
+
+    # linear binning, each sample split between its two neighbouring grid points
+    pos = (mu - lo) / delta
+    ind = np.floor(pos).astype(int)
+    w = pos - ind
+    counts = np.bincount(ind, weights=1 - w, minlength=M) + np.bincount(ind + 1, weights=w, minlength=M)
+
+    # derivative-of-Gaussian kernel evaluated at grid offsets (x - mu)
+    fact = -(1 / (((2 * np.pi) ** 0.5) * N * s ** 3.))
+    xmm = delta * np.arange(-K, K + 1)
+    kern = fact * np.exp(-(xmm ** 2.) / (2 * s ** 2.)) * xmm
+
+    dens = signal.fftconvolve(counts, kern, mode='same')
+    return grid, dens
+
+def binned_deriv_pdf(x, grid, dens):
+    """
+    Interpolate the binned first derivative of Gaussian KDE PDF at x.
+    Drop-in replacement for first_deriv_pdf as the f argument of the rootfinders,
+    with fargs=binned_kde_deriv(mu, s).
+
+    Parameters:
+        x (float or array-like): point(s) at which to evaluate the first derivative.
+        grid (numpy.ndarray): Regular grid returned by binned_kde_deriv.
+        dens (numpy.ndarray): First derivative on grid returned by binned_kde_deriv.
+
+    Returns:
+        float or numpy.ndarray: Value of the first derivative at point(s) x, 0 outside of grid.
+    """
+    return np.interp(x, grid, dens, left=0., right=0.)
 
 def recursive_rootfinding(a, b, tol, fargs, f=first_deriv_pdf):
     """
@@ -44,8 +106,8 @@ def recursive_rootfinding(a, b, tol, fargs, f=first_deriv_pdf):
     mp = (b + a) / 2.  # Midpoint
         
     if (b - a) > tol:  # Not within tolerance, refine search
-        roots += recursive_rootfinding(a, mp, tol, fargs)  # Check left side
-        roots += recursive_rootfinding(mp, b, tol, fargs)  # Check right side 
+        roots += recursive_rootfinding(a, mp, tol, fargs, f=f)  # Check left side
+        roots += recursive_rootfinding(mp, b, tol, fargs, f=f)  # Check right side 
     else:  # Within tolerance, determine if root or not
         if is_root(f(a, *fargs), f(b, *fargs)):  # Use midpoint as root
             return [mp]
@@ -54,35 +116,230 @@ def recursive_rootfinding(a, b, tol, fargs, f=first_deriv_pdf):
     
     return roots
 
-#generate a synthetic bimodal distribution to find roots on
-n=2000 # n for each sample
-
-m1, s1 = 2, 1 #mean, sigma
-m2, s2 = -2, 1 #mean, sigma
-
-samp1 = np.random.normal(loc=m1, scale=s1, size=n)
-samp2 = np.random.normal(loc=m2, scale=s2, size=n)
-ss= np.concatenate((samp1,samp2))
-
-# Plot the distributions
-fig=plt.figure(figsize=(5, 5))
-#plot histogram of samples
-plt.hist(ss, bins =100, alpha=0.5, color='blue', density=True, label = 'Samples')
-#fit a kernel density estimate (KDE) to distribution
-kde= stats.gaussian_kde(ss)
-p = np.linspace(-5,5,1000)
-plt.plot(p, kde(p), color = 'k', linestyle='--', lw=3)
-
-#find roots of KDE using recursive rootfinding algo.
-bw = 0.45730505192732634 * np.std(ss) #use Scott's Rule for bandwidth smoothing
-roots = recursive_rootfinding(np.min(ss), np.max(ss), tol=bw/10, fargs=(ss, bw))
-#plot roots
-plt.scatter(roots, kde(roots), color ='tab:red',s=100,zorder=2, label='roots')
-
-
-plt.xlabel('x')
-plt.ylabel('Density')
-plt.legend()
-plt.grid(True)
-fig.savefig('./root_finding.png')
-plt.show()
+def gridscan_rootfinding(a, b, tol, fargs, f=first_deriv_pdf, xtol=None, full_output=False):
+    """
+    Find roots of a function within a given interval by scanning a grid and refining brackets.
+
+    The function is evaluated on the whole grid (spacing <= tol) in a single vectorized call,
+    sign changes between neighbouring grid points are found with array operations and only
+    those bracketing intervals are refined with Brent's method. Unlike recursive_rootfinding,
+    intervals without a sign change cost nothing beyond the initial grid evaluation.
+
+    Parameters:
+        a (float): Lower bound of the interval.
+        b (float): Upper bound of the interval.
+        tol (float): Grid spacing used to scan for sign changes.
+        fargs (tuple): Additional arguments to be passed to the function f.
+        f (function): Function to be evaluated, must accept an array of points.
+        xtol (float, optional): Absolute tolerance for the Brent refinement (defaults to tol/1000).
+        full_output (bool, optional): If True, also return the number of function evaluations.
+
+    Returns:
+        list: List of roots within the given interval.
+        int: Number of function evaluations (only if full_output is True).
+    """
+    if xtol is None:
+        xtol = tol / 1000.
+    n = max(int(np.ceil((b - a) / tol)), 1) + 1 # number of grid points, spacing <= tol
+    grid = np.linspace(a, b, n)
+    fs = np.asarray(f(grid, *fargs))
+    nfev = n # count each grid point as an evaluation
+
+    roots = list(grid[fs == 0]) # grid points landing exactly on a root
+    brackets = np.flatnonzero(is_root(fs[:-1], fs[1:])) # intervals with a sign change
+
+    for i in brackets: # refine only intervals which contain a root
+        root, res = optimize.brentq(lambda xx: float(f(xx, *fargs)), grid[i], grid[i + 1],
+                                    xtol=xtol, full_output=True)
+        roots.append(root)
+        nfev += res.function_calls
+
+    roots = sorted(roots)
+    if full_output:
+        return roots, nfev
+    return roots
+
+##### Batched rootfinding for gridded ensembles
+def _kde_roots_chunk(samples, tol_frac=0.1, xtol_frac=1e-3):
+    """
+    Find roots of the first derivative of Gaussian KDE PDF for a chunk of independent sample sets.
+
+    Every sample set is scanned on its own grid (spacing <= tol_frac * bandwidth) in one
+    vectorized evaluation, then all bracketing intervals of the chunk are refined together
+    by vectorized bisection.
+
+    Parameters:
+        samples (numpy.ndarray): Samples with shape (npoint, nsample).
+        tol_frac (float, optional): Grid spacing as a fraction of each point's bandwidth.
+        xtol_frac (float, optional): Refinement tolerance as a fraction of each point's bandwidth.
+
+    Returns:
+        tuple: (roots, modes) lists of per-point arrays of roots and whether each root is a mode (maximum).
+    """
+    samples = np.asarray(samples, dtype=float)
+    P, N = samples.shape
+    lo, hi = samples.min(axis=1), samples.max(axis=1)
+    bw = N ** (-1. / 5) * samples.std(axis=1) # Scott's Rule for bandwidth smoothing
+    valid = np.isfinite(bw) & (bw > 0) # skip points with missing data or no spread
+    fact = np.zeros(P)
+    fact[valid] = -(1 / (((2 * np.pi) ** 0.5) * N * bw[valid] ** 3.))
+
+    def deriv(x, rows):
+        # first_deriv_pdf for x with shape (len(rows), ...) against each row's own samples and bandwidth
+        xmm = x[..., None] - samples[rows].reshape((len(rows),) + (1,) * (x.ndim - 1) + (N,))
+        s = bw[rows].reshape((-1,) + (1,) * x.ndim)
+        return fact[rows].reshape((-1,) + (1,) * (x.ndim - 1)) * \
+            (np.exp(-(xmm ** 2.) / (2 * s ** 2.)) * xmm).sum(axis=-1)
+
+    rows = np.flatnonzero(valid)
+    roots = [np.array([])] * P
+    modes = [np.array([], dtype=bool)] * P
+    if len(rows) == 0:
+        return roots, modes
+
+    # one common number of grid points for the chunk, so the scan is a single array operation
+    G = int(np.ceil(((hi - lo)[rows] / (tol_frac * bw[rows])).max())) + 1
+    grid = lo[rows, None] + (hi - lo)[rows, None] * np.linspace(0, 1, G)[None, :]
+    fs = deriv(grid, rows)
+
+    # brackets (point, interval) containing a sign change
+    bp, bi = np.nonzero(is_root(fs[:, :-1], fs[:, 1:]))
+    a, b = grid[bp, bi], grid[bp, bi + 1]
+    fa = fs[bp, bi]
+    brow = rows[bp]
+    niter = int(np.ceil(np.log2(tol_frac / xtol_frac))) + 1
+    for _ in range(niter): # vectorized bisection on every bracket at once
+        mp = (a + b) / 2.
+        fm = deriv(mp[:, None], brow)[:, 0]
+        left = is_root(fa, fm)
+        b = np.where(left, mp, b)
+        a = np.where(left, a, mp)
+        fa = np.where(left, fa, fm)
+    r = (a + b) / 2.
+    ismode = fs[bp, bi] > 0 # derivative going from + to - is a maximum of the PDF
+
+    # grid points landing exactly on a root, a maximum if the derivative goes from + before to - after
+    zp, zi = np.nonzero(fs == 0)
+    inner = (zi > 0) & (zi < G - 1)
+    zmode = np.zeros(len(zp), dtype=bool)
+    zmode[inner] = (fs[zp[inner], zi[inner] - 1] > 0) & (fs[zp[inner], zi[inner] + 1] < 0)
+    r = np.concatenate((r, grid[zp, zi]))
+    ismode = np.concatenate((ismode, zmode))
+    brow = np.concatenate((brow, rows[zp]))
+
+    order = np.lexsort((r, brow))
+    r, ismode, brow = r[order], ismode[order], brow[order]
+    splits = np.searchsorted(brow, np.arange(P + 1))
+    for p in rows:
+        roots[p] = r[splits[p]:splits[p + 1]]
+        modes[p] = ismode[splits[p]:splits[p + 1]]
+    return roots, modes
+
+def _gridpoint_chunks(da, sample_dim, chunk_size):
+    # (npoint, nsample) blocks of at most chunk_size gridpoints, read block by block along the
+    # first spatial dimension so a lazily loaded (file or dask backed) field is never fully in memory
+    spatial_dims = [d for d in da.dims if d != sample_dim]
+    if not spatial_dims:
+        yield np.asarray(da.values, dtype=float).reshape((1, -1))
+        return
+    d0 = spatial_dims[0]
+    per_row = int(np.prod([da.sizes[d] for d in spatial_dims[1:]]))
+    nrow = max(chunk_size // max(per_row, 1), 1)
+    for j in range(0, da.sizes[d0], nrow):
+        block = np.asarray(da.isel({d0: slice(j, j + nrow)}).values, dtype=float).reshape((-1, da.sizes[sample_dim]))
+        for i in range(0, len(block), chunk_size):
+            yield block[i:i + chunk_size]
+
+def gridded_rootfinding(da, sample_dim='ens_mem', tol_frac=0.1, xtol_frac=1e-3, chunk_size=2000, nproc=None):
+    """
+    Find modes and antimodes (roots of the first derivative of Gaussian KDE PDF) at every gridpoint.
+
+    Bandwidths follow Scott's Rule per gridpoint. Gridpoints are read and processed in vectorized chunks,
+    which are spread over a process pool with only a few chunks in flight. Memory per chunk scales with
+    chunk_size * nsample * (number of scan points), so reduce chunk_size for large samples.
+
+    Parameters:
+        da (xarray.DataArray): Data with a sample dimension, e.g. (ens_mem, lat, lon).
+        sample_dim (str, optional): Name of the sample dimension.
+        tol_frac (float, optional): Scan grid spacing as a fraction of the bandwidth.
+        xtol_frac (float, optional): Root tolerance as a fraction of the bandwidth.
+        chunk_size (int, optional): Number of gridpoints handled per vectorized chunk.
+        nproc (int, optional): Number of worker processes, 1 to run serially (defaults to all cores).
+
+    Returns:
+        xarray.Dataset: 'roots' padded with NaN along a new 'root' dimension, 'ismode' flagging
+        maxima of the PDF and 'nmodes', the number of modes at each gridpoint.
+    """
+    da = da.transpose(..., sample_dim)
+    spatial_dims = [d for d in da.dims if d != sample_dim]
+    chunks = _gridpoint_chunks(da, sample_dim, chunk_size)
+
+    if nproc == 1:
+        results = [_kde_roots_chunk(c, tol_frac, xtol_frac) for c in chunks]
+    else:
+        results = []
+        pending = deque()
+        nworker = nproc or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=nworker) as pool:
+            for c in chunks: # bounded number of chunks in flight, results kept in order
+                pending.append(pool.submit(_kde_roots_chunk, c, tol_frac, xtol_frac))
+                if len(pending) >= 2 * nworker:
+                    results.append(pending.popleft().result())
+            results.extend(f.result() for f in pending)
+    roots = [r for res in results for r in res[0]]
+    modes = [m for res in results for m in res[1]]
+
+    # pad ragged roots into a regular array
+    nroot = np.array([len(r) for r in roots])
+    R = max(nroot.max(), 1) if len(nroot) else 1
+    rootarr = np.full((len(roots), R), np.nan)
+    modearr = np.zeros((len(roots), R), dtype=bool)
+    mask = np.arange(R)[None, :] < nroot[:, None]
+    if len(roots):
+        rootarr[mask] = np.concatenate(roots)
+        modearr[mask] = np.concatenate(modes)
+
+    shape = tuple(da.sizes[d] for d in spatial_dims)
+    coords = {k: v for k, v in da.coords.items() if sample_dim not in v.dims}
+    return xr.Dataset({'roots': (spatial_dims + ['root'], rootarr.reshape(shape + (R,))),
+                       'ismode': (spatial_dims + ['root'], modearr.reshape(shape + (R,))),
+                       'nmodes': (spatial_dims, modearr.sum(axis=1).reshape(shape))},
+                      coords=coords)
+
+if __name__ == '__main__':
+    #generate a synthetic bimodal distribution to find roots on
+    n=2000 # n for each sample
+
+    m1, s1 = 2, 1 #mean, sigma
+    m2, s2 = -2, 1 #mean, sigma
+
+    samp1 = np.random.normal(loc=m1, scale=s1, size=n)
+    samp2 = np.random.normal(loc=m2, scale=s2, size=n)
+    ss= np.concatenate((samp1,samp2))
+
+    # Plot the distributions
+    fig=plt.figure(figsize=(5, 5))
+    #plot histogram of samples
+    plt.hist(ss, bins =100, alpha=0.5, color='blue', density=True, label = 'Samples')
+    #fit a kernel density estimate (KDE) to distribution
+    kde= stats.gaussian_kde(ss)
+    p = np.linspace(-5,5,1000)
+    plt.plot(p, kde(p), color = 'k', linestyle='--', lw=3)
+
+    #find roots of KDE using grid-scan rootfinding algo. (recursive_rootfinding gives the same roots, at far higher cost)
+    bw = 0.45730505192732634 * np.std(ss) #use Scott's Rule for bandwidth smoothing
+    roots, nfev = gridscan_rootfinding(np.min(ss), np.max(ss), tol=bw/10, fargs=(ss, bw), full_output=True)
+    print('Found {} roots with {} KDE evaluations'.format(len(roots), nfev))
+    #for very large samples, bin the samples once and search the FFT-convolved derivative instead
+    roots_binned = gridscan_rootfinding(np.min(ss), np.max(ss), tol=bw/10, fargs=binned_kde_deriv(ss, bw), f=binned_deriv_pdf)
+    print('Binned/FFT roots: {}'.format(np.round(roots_binned, 3)))
+    #plot roots
+    plt.scatter(roots, kde(roots), color ='tab:red',s=100,zorder=2, label='roots')
+
+
+    plt.xlabel('x')
+    plt.ylabel('Density')
+    plt.legend()
+    plt.grid(True)
+    fig.savefig('./root_finding.png')
+    plt.show()
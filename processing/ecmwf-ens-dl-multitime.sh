@@ -5,8 +5,10 @@ DATE='20240214' # date of fcast init.
 TIME_RANGE=($(seq 0 6 48)) #validation times (from fcast init)
 
 #TODO: pass LEVS and VARS as argument for flexibility
+#for many dates/lead times use ecmwf_ens_download.py, which fetches them concurrently with merged byte ranges, e.g.
+#python ecmwf_ens_download.py 20240214 --steps 0:144:3 150:360:6 --params t u v --levels 800 1000
 
 # Loop over the array of times
 for TIME in "${TIME_RANGE[@]}"; do
-    bash dl_singletime.sh "$TIME" "$DATE"
+    bash "$(dirname "$0")/ecmwf-ens-dl-singletime.sh" "$TIME" "$DATE"
 done
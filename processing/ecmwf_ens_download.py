@@ -0,0 +1,313 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import threading
+import http.client
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+#real time ensemble forecasts, see https://www.ecmwf.int/en/forecasts/datasets/open-data
+ROOT_URL = 'https://data.ecmwf.int/forecasts/{date}/{cycle:02d}z/0p4-beta/enfo/'
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class DownloadError(IOError):
+    pass
+
+
+class RangeSession:
+    """
+    Keep-alive HTTP(S) connections shared by all requests of a download, one per thread and host,
+    so worker threads reuse their connection instead of opening one per request.
+
+    Parameters:
+        timeout (float, optional): Socket timeout in seconds.
+    """
+    def __init__(self, timeout=60.):
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self, url):
+        conns = self._local.__dict__.setdefault('conns', {})
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        if key not in conns:
+            cls = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+            conns[key] = cls(parts.netloc, timeout=self.timeout)
+        return conns[key]
+
+    def reset(self, url):
+        """
+        Close and forget this thread's connection to url's host (e.g. after an error).
+        """
+        conns = self._local.__dict__.get('conns', {})
+        parts = urlsplit(url)
+        conn = conns.pop((parts.scheme, parts.netloc), None)
+        if conn is not None:
+            conn.close()
+
+    def get(self, url, headers=None):
+        """
+        Send a GET request, the response must be read fully before the next request on this thread.
+        """
+        parts = urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        conn = self._connection(url)
+        conn.request('GET', path, headers=headers or {})
+        return conn.getresponse()
+
+
+def download(session, url, path, start=0, end=None, retries=5, backoff=1.):
+    """
+    Download url (or the byte range start-end of it, inclusive) to path.
+
+    Data is streamed into path + '.part'; when a request fails the next attempt resumes from the
+    bytes already written. The file is renamed to path only once complete, so an existing path
+    is never downloaded again.
+
+    Parameters:
+        session (RangeSession): Connections to use.
+        url (str): URL to download.
+        path (str): Output file.
+        start, end (int, optional): First and last byte to download, whole file if end is None.
+        retries (int, optional): Number of retries after a failed request.
+        backoff (float, optional): Seconds to wait before the first retry, doubled for each retry.
+
+    Returns:
+        str: path
+    """
+    if os.path.exists(path):
+        return path
+    part = path + '.part'
+    length = None if end is None else end - start + 1
+    for attempt in range(retries + 1):
+        have = os.path.getsize(part) if os.path.exists(part) else 0
+        if length is not None and have >= length:
+            break
+        headers = {}
+        if have or end is not None or start:
+            headers['Range'] = 'bytes={}-{}'.format(start + have, '' if end is None else end)
+        try:
+            resp = session.get(url, headers)
+            if resp.status == 416 and end is None and have: #whole file was already there
+                resp.read()
+                break
+            if resp.status not in (200, 206):
+                resp.read()
+                if resp.status in RETRY_STATUS:
+                    raise http.client.HTTPException('HTTP {} for {}'.format(resp.status, url))
+                raise DownloadError('HTTP {} for {}'.format(resp.status, url))
+            if resp.status == 200 and (start or end is not None):
+                resp.read()
+                raise DownloadError('Server ignored the byte range requested from {}'.format(url))
+            #a 200 is the whole file, so start over
+            with open(part, 'ab' if resp.status == 206 else 'wb') as fp:
+                shutil.copyfileobj(resp, fp, 1 << 20)
+            #http.client doesn't raise when a connection drops early, compare with the announced size
+            size = resp.getheader('Content-Length')
+            if size is not None and os.path.getsize(part) < (have if resp.status == 206 else 0) + int(size):
+                raise http.client.IncompleteRead(b'', int(size))
+            if length is None or os.path.getsize(part) >= length:
+                break
+        except (OSError, http.client.HTTPException) as e:
+            if isinstance(e, DownloadError):
+                raise
+            session.reset(url)
+            if attempt == retries:
+                raise DownloadError('Failed to download {} after {} attempts: {}'.format(url, retries + 1, e))
+            time.sleep(backoff * 2**attempt)
+    else:
+        raise DownloadError('Failed to download {} after {} attempts'.format(url, retries + 1))
+    os.replace(part, path)
+    return path
+
+
+############
+#INDEX FILES
+def file_name(date, step, cycle=0):
+    """
+    Name of the forecast files (without extension) for an initialization date, cycle and lead time.
+    """
+    return '{}{:02d}0000-{}h-enfo-ef'.format(date, cycle, step)
+
+def read_index(path):
+    """
+    Parse a .index file, one JSON object per GRIB message.
+
+    Returns:
+        list: dicts with the message's keys (param, levelist, number, step, ...) plus _offset and _length.
+    """
+    with open(path) as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+def select_entries(entries, params=None, levels=None, members=None, steps=None):
+    """
+    Keep the index entries matching all given selections (None keeps everything).
+
+    Parameters:
+        entries (list): Index entries from read_index.
+        params (list, optional): Parameter short names, e.g. ['t', 'u', 'v'].
+        levels (list, optional): Pressure levels, e.g. [800, 1000]; messages without a level are dropped.
+        members (list, optional): Ensemble members, the control forecast is member 0.
+        steps (list, optional): Lead times in hours.
+
+    Returns:
+        list: Selected entries.
+    """
+    def keep(value, allowed):
+        return allowed is None or (value is not None and str(value) in allowed)
+    params, levels, members, steps = [None if a is None else {str(v) for v in a} for a in (params, levels, members, steps)]
+    return [e for e in entries
+            if keep(e.get('param'), params) and keep(e.get('levelist'), levels)
+            and keep(e.get('number', 0), members) and keep(e.get('step'), steps)]
+
+def coalesce_ranges(entries, max_gap=0):
+    """
+    Merge the byte ranges of entries that are adjacent or at most max_gap bytes apart,
+    so fewer (larger) requests are needed. Bytes in the gaps are downloaded and dropped later.
+
+    Parameters:
+        entries (list): Index entries with _offset and _length.
+        max_gap (int, optional): Largest gap in bytes bridged between two messages.
+
+    Returns:
+        list: (start, end, entries) of each merged range, end is inclusive.
+    """
+    groups = []
+    for e in sorted(entries, key=lambda e: e['_offset']):
+        s, t = e['_offset'], e['_offset'] + e['_length'] - 1
+        if groups and s <= groups[-1][1] + 1 + max_gap:
+            groups[-1][1] = max(groups[-1][1], t)
+            groups[-1][2].append(e)
+        else:
+            groups.append([s, t, [e]])
+    return [tuple(g) for g in groups]
+
+
+############
+#DOWNLOAD
+def _range_path(cache_dir, url, start, end):
+    return os.path.join(cache_dir, 'ranges', '{}-{}-{}'.format(hashlib.sha1(url.encode()).hexdigest()[:16], start, end))
+
+def assemble(groups, paths, outpath):
+    """
+    Write the selected messages, in file order, from downloaded merged ranges into a single GRIB file.
+    """
+    tmp = outpath + '.part'
+    with open(tmp, 'wb') as out:
+        for (start, end, entries), path in zip(groups, paths):
+            with open(path, 'rb') as fp:
+                for e in entries:
+                    fp.seek(e['_offset'] - start)
+                    out.write(fp.read(e['_length']))
+    os.replace(tmp, outpath)
+    return outpath
+
+def download_subset(dates, steps, params=None, levels=None, members=None, outdir='.', cache_dir=None, cycle=0,
+                    root_url=ROOT_URL, max_gap=1 << 18, workers=16, retries=5, verbose=True):
+    """
+    Download a subset of the ECMWF real time ensemble for many dates and lead times concurrently.
+
+    Index files are fetched and parsed for every (date, step), the selected messages' byte ranges
+    are merged (coalesce_ranges) and all ranges of all files are fetched by a thread pool sharing
+    keep-alive connections. Index files and ranges are cached in cache_dir, partial downloads
+    resume and existing output files are skipped, so an interrupted run can simply be restarted.
+
+    Parameters:
+        dates (list): Initialization dates, 'YYYYMMDD'.
+        steps (list): Lead times in hours.
+        params, levels, members (list, optional): Selection, see select_entries.
+        outdir (str, optional): Directory for the GRIB files, one per date and step.
+        cache_dir (str, optional): Directory for index files and downloaded ranges, default outdir/.cache.
+        cycle (int, optional): Initialization hour.
+        root_url (str, optional): URL of the forecast directory, formatted with date and cycle.
+        max_gap (int, optional): Largest gap in bytes bridged when merging ranges.
+        workers (int, optional): Number of concurrent requests.
+        retries (int, optional): Retries of each failed request.
+        verbose (bool, optional): Print progress and a final report.
+
+    Returns:
+        list: Paths of the GRIB files, in the order of dates then steps (None where nothing matched).
+    """
+    cache_dir = os.path.join(outdir, '.cache') if cache_dir is None else cache_dir
+    for d in (outdir, os.path.join(cache_dir, 'index'), os.path.join(cache_dir, 'ranges')):
+        os.makedirs(d, exist_ok=True)
+    session = RangeSession()
+    t0 = time.perf_counter()
+    nbytes = [0]
+    lock = threading.Lock()
+
+    def fetch(date, step):
+        prefix = '' if cycle == 0 else '{:02d}z'.format(cycle)
+        outpath = os.path.join(outdir, '{}{}-{}h-ecmwf-ens.grib2'.format(date, prefix, step))
+        if os.path.exists(outpath):
+            return outpath
+        url = root_url.format(date=date, cycle=cycle) + file_name(date, step, cycle)
+        index = download(session, url + '.index', os.path.join(cache_dir, 'index', file_name(date, step, cycle) + '.index'),
+                         retries=retries)
+        groups = coalesce_ranges(select_entries(read_index(index), params, levels, members), max_gap)
+        if not groups:
+            print('No messages selected for {} {}h'.format(date, step))
+            return None
+        paths = [_range_path(cache_dir, url + '.grib2', s, e) for s, e, _ in groups]
+        #ranges go to their own pool, this one only waits on index files and assembles
+        list(range_pool.map(lambda a: download(session, url + '.grib2', a[0], a[1], a[2], retries=retries),
+                            [(p, s, e) for p, (s, e, _) in zip(paths, groups)]))
+        assemble(groups, paths, outpath)
+        with lock:
+            nbytes[0] += sum(e - s + 1 for s, e, _ in groups)
+        if verbose:
+            print('{} {}h: {} messages in {} requests'.format(date, step, sum(len(g[2]) for g in groups), len(groups)))
+        return outpath
+
+    with ThreadPoolExecutor(workers) as range_pool, ThreadPoolExecutor(workers) as file_pool:
+        futures = [file_pool.submit(fetch, date, step) for date in dates for step in steps]
+        out = [f.result() for f in futures]
+
+    if verbose:
+        dt = time.perf_counter() - t0
+        print('Retrieved {:.1f} MB in {:.1f}s ({:.1f} MB/s)'.format(nbytes[0]/1e6, dt, nbytes[0]/1e6/max(dt, 1e-9)))
+    return out
+
+
+def parse_list(values):
+    """
+    Expand 'start:stop:step' (stop inclusive, like MARS' 'start/to/stop/by/step') and plain values.
+    """
+    out = []
+    for v in values:
+        if ':' in v:
+            start, stop, step = (list(map(int, v.split(':'))) + [1])[:3]
+            out.extend(range(start, stop + 1, step))
+        else:
+            out.append(int(v) if v.isdigit() else v)
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Download a subset of the ECMWF real time ensemble.')
+    parser.add_argument('dates', nargs='+', help='initialization dates, YYYYMMDD')
+    parser.add_argument('--cycle', type=int, default=0, help='initialization hour')
+    parser.add_argument('--steps', nargs='+', default=['0:48:6'], help="lead times in hours, e.g. 0:144:3 150:360:6")
+    parser.add_argument('--params', nargs='+', default=['t', 'u', 'v'])
+    parser.add_argument('--levels', nargs='+', default=['800', '1000'])
+    parser.add_argument('--members', nargs='+', help='ensemble members (0 is the control), e.g. 0:50, default all')
+    parser.add_argument('--outdir', default='.')
+    parser.add_argument('--cache-dir', help='index files and downloaded ranges, default OUTDIR/.cache')
+    parser.add_argument('--root-url', default=ROOT_URL, help='forecast directory, formatted with {date} and {cycle}')
+    parser.add_argument('--max-gap', type=int, default=1 << 18, help='largest gap in bytes bridged between messages')
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--retries', type=int, default=5)
+    args = parser.parse_args()
+
+    download_subset(args.dates, parse_list(args.steps), params=args.params, levels=args.levels,
+                    members=parse_list(args.members) if args.members else None, outdir=args.outdir,
+                    cache_dir=args.cache_dir, cycle=args.cycle, root_url=args.root_url, max_gap=args.max_gap,
+                    workers=args.workers, retries=args.retries)
+
+
+if __name__ == '__main__':
+    main()
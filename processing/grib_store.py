@@ -0,0 +1,224 @@
+import os
+import argparse
+import numpy as np
+import xarray as xr
+import dask.array as da
+import eccodes as ec
+
+DIMS = ('init', 'step', 'member', 'level', 'lat', 'lon')
+
+
+############
+#GRIB DECODING
+def _member(h):
+    #ensemble member of a message, 0 for fields without one (e.g. deterministic)
+    if not ec.codes_is_defined(h, 'number'):
+        return 0
+    return ec.codes_get(h, 'number', ktype=int) or 0
+
+def scan_grib(path):
+    """
+    Read the headers of every message in a GRIB file, without decoding the data.
+
+    Returns:
+        list: dicts with var, init (numpy.datetime64), step (hours), member, level and the grid.
+    """
+    out = []
+    with open(path, 'rb') as f:
+        while True:
+            h = ec.codes_grib_new_from_file(f, headers_only=True)
+            if h is None:
+                break
+            try:
+                date, hhmm = ec.codes_get(h, 'dataDate'), ec.codes_get(h, 'dataTime')
+                init = np.datetime64('{}-{}-{}T{:02d}:{:02d}'.format(str(date)[:4], str(date)[4:6], str(date)[6:],
+                                                                  hhmm // 100, hhmm % 100), 'ns')
+                out.append({'var': ec.codes_get(h, 'shortName'), 'init': init,
+                            'step': ec.codes_get(h, 'endStep'), 'member': _member(h),
+                            'level': ec.codes_get(h, 'level'),
+                            'grid': tuple(ec.codes_get(h, k) for k in ('Nj', 'Ni', 'latitudeOfFirstGridPointInDegrees',
+                                          'latitudeOfLastGridPointInDegrees', 'longitudeOfFirstGridPointInDegrees',
+                                          'longitudeOfLastGridPointInDegrees'))})
+            finally:
+                ec.codes_release(h)
+    return out
+
+def grid_coords(grid):
+    """
+    Latitudes and longitudes of a regular lat/lon grid from scan_grib's grid tuple.
+    """
+    nlat, nlon, lat0, lat1, lon0, lon1 = grid
+    if lon1 < lon0:
+        lon1 += 360.
+    return np.linspace(lat0, lat1, nlat), np.linspace(lon0, lon1, nlon)
+
+def decode_grib(path, variables, members, levels, shape, out=None):
+    """
+    Decode every message of a GRIB file (one init and step) into arrays (member, level, lat, lon).
+
+    Parameters:
+        path (str): GRIB file.
+        variables (list): Names of the variables to decode, others are skipped.
+        members, levels (list): Coordinates of the member and level dimensions.
+        shape (tuple): (nlat, nlon) of the grid.
+        out (dict, optional): Arrays (member, level, lat, lon) of each variable to decode into.
+
+    Returns:
+        dict: float32 arrays for each variable, NaN where a message is missing.
+    """
+    imem = {m: i for i, m in enumerate(members)}
+    ilev = {l: i for i, l in enumerate(levels)}
+    if out is None:
+        out = {v: np.full((len(members), len(levels)) + tuple(shape), np.nan, dtype=np.float32) for v in variables}
+    with open(path, 'rb') as f:
+        while True:
+            h = ec.codes_grib_new_from_file(f)
+            if h is None:
+                break
+            try:
+                var = ec.codes_get(h, 'shortName')
+                if var not in out:
+                    continue
+                mem, lev = _member(h), ec.codes_get(h, 'level')
+                if mem not in imem or lev not in ilev:
+                    raise ValueError('{}: member {} level {} of {} is not in the store'.format(path, mem, lev, var))
+                out[var][imem[mem], ilev[lev]] = ec.codes_get_values(h).reshape(shape)
+            finally:
+                ec.codes_release(h)
+    return out
+
+
+############
+#STORE
+def default_chunks(nstep, nmember, nlat, nlon, step_chunk=8, target_bytes=8e6):
+    """
+    Chunk sizes suited to both gridpoint time series across members and full-field maps.
+
+    A chunk holds every member for a block of step_chunk lead times over a square lat/lon tile,
+    with the tile sized so a chunk is about target_bytes (float32, before compression). A time series
+    at one point then reads nstep/step_chunk chunks, and a map of one step reads one block of tiles.
+
+    Returns:
+        dict: Chunk size of each dimension.
+    """
+    step_chunk = min(step_chunk, nstep)
+    tile = int(np.sqrt(target_bytes / (4 * step_chunk * nmember)))
+    return {'init': 1, 'step': step_chunk, 'member': nmember, 'level': 1,
+            'lat': max(1, min(tile, nlat)), 'lon': max(1, min(tile, nlon))}
+
+def _template(variables, inits, steps, members, levels, lat, lon, chunks):
+    #lazy all-NaN dataset, only used to write metadata and extend the init dimension
+    shape = (len(inits), len(steps), len(members), len(levels), len(lat), len(lon))
+    data = {v: (DIMS, da.full(shape, np.nan, dtype=np.float32, chunks=tuple(chunks[d] for d in DIMS)))
+            for v in variables}
+    return xr.Dataset(data, coords={'init': np.asarray(inits, dtype='datetime64[ns]'),
+                                    'step': ('step', np.asarray(steps), {'long_name': 'lead time (hours)'}),
+                                    'member': np.asarray(members), 'level': np.asarray(levels),
+                                    'lat': lat, 'lon': lon})
+
+def ingest(paths, store, steps=None, chunks=None, verbose=True):
+    """
+    Decode downloaded GRIB subsets once into a chunked, compressed zarr store (init, step, member, level, lat, lon).
+
+    Files may hold any init and step (e.g. one ecmwf_ens_download.py output per lead time); they are
+    grouped by init from their headers. New inits are appended along init and inits already in the
+    store are skipped, so ingest can be rerun as new forecasts arrive. Each file is decoded once, and
+    the files of an init are written one whole step chunk at a time, so no chunk is ever read back and
+    rewritten. Missing steps or messages read as NaN.
+    Open the result lazily with xarray.open_zarr(store).
+
+    Parameters:
+        paths (list): GRIB files.
+        store (str): Path of the zarr store, created if needed.
+        steps (list, optional): Lead times (hours) of the step dimension, default those found in paths
+            (for an existing store, those of the store, and any other steps are an error).
+        chunks (dict, optional): Chunk sizes of a new store, default from default_chunks.
+        verbose (bool, optional): Print progress.
+
+    Returns:
+        list: Inits that were added.
+    """
+    headers = {p: scan_grib(p) for p in paths}
+    headers = {p: h for p, h in headers.items() if h}
+    allh = [m for h in headers.values() for m in h]
+    if not allh:
+        return []
+
+    exists = os.path.exists(store)
+    if exists:
+        old = xr.open_zarr(store)
+        if steps is not None and list(steps) != old.step.data.tolist():
+            raise ValueError('steps {} differ from those of {}: {}'.format(list(steps), store, old.step.data.tolist()))
+        variables, steps = list(old.data_vars), old.step.data.tolist()
+        members, levels = old.member.data.tolist(), old.level.data.tolist()
+        lat, lon = old.lat.data, old.lon.data
+        done = set(old.init.data)
+        ninit = old.sizes['init']
+    else:
+        variables = sorted({m['var'] for m in allh})
+        steps = sorted({m['step'] for m in allh}) if steps is None else list(steps)
+        members = sorted({m['member'] for m in allh})
+        levels = sorted({m['level'] for m in allh})
+        lat, lon = grid_coords(allh[0]['grid'])
+        done, ninit = set(), 0
+        if chunks is None:
+            chunks = default_chunks(len(steps), len(members), len(lat), len(lon))
+
+    if any(m['grid'] != allh[0]['grid'] for m in allh) or (len(lat), len(lon)) != allh[0]['grid'][:2]:
+        raise ValueError('All GRIB files must be on the grid of the store')
+
+    #files of each new init, in init order
+    byinit = {}
+    for p, h in headers.items():
+        init = h[0]['init']
+        if len({(m['init'], m['step']) for m in h}) > 1:
+            raise ValueError('{} holds more than one init or step'.format(p))
+        if h[0]['step'] not in steps:
+            raise ValueError('{}: step {}h is not in the store'.format(p, h[0]['step']))
+        if init not in done:
+            byinit.setdefault(init, []).append(p)
+    inits = sorted(byinit)
+    if not inits:
+        return []
+
+    #metadata for all new inits at once, the data is only written region by region below
+    chunks = chunks if not exists else {d: old.chunks[d][0] for d in DIMS}
+    template = _template(variables, inits, steps, members, levels, lat, lon, chunks)
+    if exists:
+        template.to_zarr(store, mode='a', append_dim='init', compute=False)
+    else:
+        template.to_zarr(store, mode='w-', compute=False,
+                         encoding={v: {'_FillValue': np.float32(np.nan)} for v in variables})
+
+    #files of each init grouped into blocks of steps matching the step chunks, each block written once
+    sc = chunks['step']
+    shape = (len(members), len(levels), len(lat), len(lon))
+    for i, init in enumerate(inits):
+        blocks = {}
+        for p in byinit[init]:
+            j = steps.index(headers[p][0]['step'])
+            blocks.setdefault(j // sc, []).append((j, p))
+        for b, files in sorted(blocks.items()):
+            j0, j1 = b * sc, min((b + 1) * sc, len(steps))
+            fields = {v: np.full((1, j1 - j0) + shape, np.nan, dtype=np.float32) for v in variables}
+            for j, p in files:
+                decode_grib(p, variables, members, levels, shape[2:], out={v: a[0, j - j0] for v, a in fields.items()})
+                if verbose:
+                    print('{} +{}h: {}'.format(str(init)[:13], steps[j], p))
+            ds = xr.Dataset({v: (DIMS, a) for v, a in fields.items()})
+            ds.to_zarr(store, region={'init': slice(ninit + i, ninit + i + 1), 'step': slice(j0, j1)})
+    return inits
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ingest downloaded GRIB ensemble subsets into a zarr store.')
+    parser.add_argument('store', help='zarr store, created or appended to')
+    parser.add_argument('paths', nargs='+', help='GRIB files, e.g. *-ecmwf-ens.grib2')
+    parser.add_argument('--steps', nargs='+', type=int, help='lead times of the store, default those found (must match an existing store)')
+    args = parser.parse_args()
+    added = ingest(args.paths, args.store, steps=args.steps)
+    print('Added {} init(s) to {}'.format(len(added), args.store))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import numpy as np
+import xarray as xr
+
+
+def local_time_shift(lon):
+    """
+    Whole hours from UTC to local solar time at each longitude (15 degrees per hour), rounded to the
+    nearest hour with halves rounded up, so every longitude has a single well defined shift.
+
+    Parameters:
+        lon (array-like): Longitudes, either -180-180 or 0-360.
+
+    Returns:
+        numpy.ndarray: Shift in hours, between -12 and 12.
+    """
+    lon = (np.asarray(lon, dtype=float) + 180.) % 360. - 180.
+    return np.floor(lon / 15. + 0.5).astype(int)
+
+def local_time_indices(times, shift, hours=(1, 13)):
+    """
+    UTC time index sampled at each local day and hour, for a single shift.
+
+    Parameters:
+        times (numpy.ndarray): Hourly UTC times (datetime64).
+        shift (int): Hours from UTC to local time (see local_time_shift).
+        hours (tuple, optional): Local hours to sample.
+
+    Returns:
+        numpy.ndarray: Local days (datetime64[D]) covered by times for any shift.
+        numpy.ndarray: Indices into times (nday, nhour), clipped to the valid range.
+        numpy.ndarray: Mask (nday, nhour), False where the local time is outside times.
+    """
+    t0 = times[0].astype('datetime64[h]')
+    days = np.arange((t0 - np.timedelta64(12, 'h')).astype('datetime64[D]'),
+                     (times[-1].astype('datetime64[h]') + np.timedelta64(12, 'h')).astype('datetime64[D]') + 1)
+    local = days[:, None].astype('datetime64[h]') + np.asarray(hours)[None, :].astype('timedelta64[h]')
+    ind = (local - np.timedelta64(int(shift), 'h') - t0).astype(int)
+    valid = (ind >= 0) & (ind < len(times))
+    return days, np.clip(ind, 0, len(times) - 1), valid
+
+def sample_local_time(da, hours=(1, 13), timedim='time', londim='longitude'):
+    """
+    Sample hourly data at fixed local solar times (e.g. 01 and 13, as CloudSat-CALIPSO overpasses).
+
+    Longitudes sharing the same shift from UTC form bands, and for each band only the UTC times
+    falling at the requested local hours are gathered (lazily, if da is dask-backed). So the output
+    is (day, local_hour, ..., lon) rather than a full (time, ..., lon) cube that is mostly NaN.
+    Local days only partly covered by da are NaN where their UTC time is missing.
+
+    Parameters:
+        da (xarray.DataArray): Hourly data with timedim and londim.
+        hours (tuple, optional): Local hours to sample.
+        timedim, londim (str, optional): Names of the time and longitude dimensions.
+
+    Returns:
+        xarray.DataArray: Samples with dims (day, local_hour, <other dims>, londim) and a coordinate
+            utc_time (day, local_hour, londim) giving the UTC time of each sample.
+    """
+    times = da[timedim].values
+    hourly = times.astype('datetime64[h]')
+    if len(times) < 2 or np.any(np.diff(hourly) != np.timedelta64(1, 'h')) or np.any(hourly != times):
+        raise ValueError('sample_local_time needs data every hour, on the hour')
+
+    da = da.transpose(timedim, ..., londim)
+    shift = local_time_shift(da[londim].values)
+    bands, cols = [], []
+    for s in np.unique(shift):
+        col = np.flatnonzero(shift == s)
+        days, ind, valid = local_time_indices(times, s, hours)
+        band = da.isel({londim: col, timedim: xr.DataArray(ind, dims=('day', 'local_hour'))}).drop_vars(timedim)
+        if not valid.all():
+            band = band.where(xr.DataArray(valid, dims=('day', 'local_hour')))
+        utc = np.where(valid, times[ind], np.datetime64('NaT'))
+        bands.append(band.assign_coords(utc_time=(('day', 'local_hour', londim), np.repeat(utc[:, :, None], len(col), axis=2))))
+        cols.append(col)
+    #back to the original longitude order
+    out = xr.concat(bands, dim=londim).isel({londim: np.argsort(np.concatenate(cols))})
+    return out.assign_coords(day=days, local_hour=np.asarray(hours)).transpose('day', 'local_hour', ...)
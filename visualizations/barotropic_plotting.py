@@ -1,3 +1,8 @@
+import io
+import os
+import time
+import hashlib
+import subprocess
 import numpy as np
 import xarray as xr
 import random
@@ -9,12 +14,16 @@ from cartopy.util import add_cyclic_point
 
 import matplotlib as mpl          
 from matplotlib.colors import BoundaryNorm
+from matplotlib.collections import LineCollection
 import matplotlib.pyplot as plt    
 import matplotlib.animation as manim
 import matplotlib.ticker as mticker
 import matplotlib.path as mpath
 
 import seaborn as sns
+from PIL import Image
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 s2d = 1/86400.
 d2r = np.pi / 180.
@@ -49,12 +58,366 @@ def add_gridlines(ax):
 
 
 
-def overview_animation(ds, times, xs, ts=None, filename = './images/overview.gif', step=3600*2):
-     """
+#+++Projected coordinates+++#
+#grids, points and vector bases already transformed into a projection, keyed by projection and coordinates,
+#only the most recently used few are kept
+_projected_cache = OrderedDict()
+_PROJECTED_CACHE_SIZE = 16
+
+def _cache_key(kind, proj, *arrays):
+    return (kind, proj) + tuple(hashlib.sha1(np.ascontiguousarray(a, dtype=float).tobytes()).hexdigest() for a in arrays)
+
+def _cached(key, compute):
+    #least recently used cache of projected arrays
+    if key in _projected_cache:
+        _projected_cache.move_to_end(key)
+    else:
+        _projected_cache[key] = compute()
+        while len(_projected_cache) > _PROJECTED_CACHE_SIZE:
+            _projected_cache.popitem(last=False)
+    return _projected_cache[key]
+
+def project_points(lon, lat, proj):
+    """
+    Project lon/lat points into proj coordinates once, later calls with the same points are cached.
+
+    Parameters:
+        lon, lat (numpy.ndarray): Longitudes and latitudes of the points, broadcastable against each other.
+        proj (cartopy.crs.Projection): Target projection (i.e. that of the axes).
+
+    Returns:
+        tuple: (X, Y) arrays of projected coordinates, with the shape of lon and lat.
+    """
+    lon, lat = np.broadcast_arrays(np.asarray(lon, dtype=float), np.asarray(lat, dtype=float))
+    def compute():
+        xyz = proj.transform_points(ccrs.PlateCarree(), lon, lat)
+        return xyz[..., 0], xyz[..., 1]
+    return _cached(_cache_key('points', proj, lon, lat), compute)
+
+def _cell_edges(c):
+    #midpoints between cell centres, extended half a cell at each end (as pcolormesh's shading='nearest')
+    mid = 0.5 * (c[1:] + c[:-1])
+    return np.concatenate([[c[0] - (mid[0] - c[0])], mid, [c[-1] + (c[-1] - mid[-1])]])
+
+def project_grid(lon, lat, proj, edges=False):
+    """
+    Project a regular lon/lat grid into proj coordinates (cached, see project_points).
+
+    Parameters:
+        lon, lat (numpy.ndarray): 1D longitudes and latitudes of the grid.
+        proj (cartopy.crs.Projection): Target projection.
+        edges (bool, optional): Return cell corners for pcolormesh instead of the grid points.
+
+    Returns:
+        tuple: (X, Y) 2D arrays of projected coordinates, (nlat, nlon) or (nlat+1, nlon+1) if edges.
+    """
+    lon, lat = np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+    if edges:
+        lon, lat = _cell_edges(lon), np.clip(_cell_edges(lat), -90, 90)
+    return project_points(*np.meshgrid(lon, lat), proj)
+
+def vector_basis(lon, lat, proj):
+    """
+    Directions in proj of eastward and northward vectors at each point, found once (cached).
+
+    Like cartopy's transform_vectors, each point is perturbed by a small step in lon and in lat
+    and projected; points where the step would leave the globe are perturbed the other way.
+
+    Parameters:
+        lon, lat (numpy.ndarray): Longitudes and latitudes of the points, broadcastable against each other.
+        proj (cartopy.crs.Projection): Target projection.
+
+    Returns:
+        tuple: (east, north) arrays with shape lon.shape + (2,), projected change per degree of lon and lat.
+    """
+    lon, lat = np.broadcast_arrays(np.asarray(lon, dtype=float), np.asarray(lat, dtype=float))
+    def compute():
+        delta = 360. / 360000 #same step as cartopy
+        src = ccrs.PlateCarree()
+        p0 = proj.transform_points(src, lon, lat)[..., :2]
+        east = (proj.transform_points(src, lon + delta, lat)[..., :2] - p0) / delta
+        dlat = np.where(lat + delta > 90, -delta, delta)
+        north = (proj.transform_points(src, lon, lat + dlat)[..., :2] - p0) / dlat[..., None]
+        return east, north
+    return _cached(_cache_key('basis', proj, lon, lat), compute)
+
+def rotate_vectors(u, v, basis):
+    """
+    Rotate (u, v) vectors into projection coordinates with a basis from vector_basis, keeping their magnitude.
+
+    Returns:
+        tuple: (U, V) vector components in projection coordinates.
+    """
+    east, north = basis
+    U = u * east[..., 0] + v * north[..., 0]
+    V = u * east[..., 1] + v * north[..., 1]
+    mag = np.hypot(u, v)
+    norm = np.hypot(U, V)
+    scale = np.divide(mag, norm, out=np.zeros_like(norm), where=norm > 0)
+    return U * scale, V * scale
+
+
+
+#+++Frame data preparation+++#
+def prepare_frames(ds, frames, variables, xdim='x', ydim='y', cyclic=360, skip=1, thinned=(), cache_dir=None):
+    """
+    Interpolate variables to every frame time at once, so animations only need to index frame k.
+
+    Linear interpolation weights in time are found once and applied to all variables in a single
+    vectorized pass, then the cyclic longitude point is appended and wind vectors are thinned.
+    Results are contiguous float32 arrays. With cache_dir each array is saved under a name keyed by a hash
+    of its inputs (data, times, frames and options) and memory-mapped from there; existing files are
+    reused instead of recomputed, and different datasets or frames never share a file.
+
+    Parameters:
+        ds (xarray.Dataset): Dataset with a time dimension plus ydim and xdim.
+        frames (numpy.ndarray): Times of each animation frame.
+        variables (list): Names of variables to prepare.
+        xdim, ydim (str, optional): Names of the longitude and latitude dimensions.
+        cyclic (float, optional): Longitude coordinate of the appended cyclic point.
+        skip (int, optional): Thinning of variables in thinned (e.g. wind vectors).
+        thinned (tuple, optional): Names of variables to thin by skip in both directions.
+        cache_dir (str, optional): Directory to cache arrays in and memory-map them from.
+
+    Returns:
+        dict: Coordinates xdim, ydim (and xdim+'_thin', ydim+'_thin') plus (nframe, ny, nx) arrays for each variable.
+    """
+    time = ds.time.data
+    i1 = np.clip(np.searchsorted(time, frames, side='right'), 1, len(time) - 1)
+    w = ((frames - time[i1 - 1]) / (time[i1] - time[i1 - 1]))[:, None, None]
+
+    x = np.append(ds[xdim].data, cyclic)
+    y = ds[ydim].data
+    out = {xdim: x, ydim: y, xdim + '_thin': x[::skip], ydim + '_thin': y[::skip]}
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+    for var in variables:
+        arr = np.asarray(ds[var].transpose('time', ydim, xdim).data)
+        if cache_dir is not None:
+            h = hashlib.sha1(np.ascontiguousarray(arr).tobytes())
+            for a in (time, frames, x, y):
+                h.update(np.ascontiguousarray(a).tobytes())
+            h.update(repr((skip if var in thinned else 1, str(arr.dtype), arr.shape)).encode())
+            fn = os.path.join(cache_dir, '{}_{}.npy'.format(var, h.hexdigest()[:16]))
+            if os.path.exists(fn): #already prepared for these inputs
+                out[var] = np.load(fn, mmap_mode='r')
+                continue
+        arr = (1 - w) * arr[i1 - 1] + w * arr[i1] #linear interpolation to all frame times
+        arr = np.concatenate([arr, arr[:, :, :1]], axis=2) #cyclic point, fixes prime meridian issue when plotting
+        if var in thinned:
+            arr = arr[:, ::skip, ::skip]
+        arr = np.ascontiguousarray(arr, dtype=np.float32)
+        if cache_dir is not None:
+            #write under a temporary name and rename, so workers never map a partly written file
+            tmp = '{}.{}.tmp.npy'.format(fn[:-4], os.getpid())
+            np.save(tmp, arr)
+            os.replace(tmp, fn)
+            arr = np.load(fn, mmap_mode='r')
+        out[var] = arr
+    return out
+
+
+#+++Trajectory overlay+++#
+def visible_counts(ts, frames):
+    """
+    Number of points of each trajectory earlier than each frame time, with a single searchsorted.
+    Trajectories are offset from one another so that all of their (increasing) times form one sorted array.
+
+    Parameters:
+        ts (numpy.ndarray): Trajectory times (ntime, ntraj), increasing along the first axis.
+        frames (numpy.ndarray): Times of each animation frame.
+
+    Returns:
+        numpy.ndarray: Counts with shape (nframe, ntraj).
+    """
+    nts, Ntraj = ts.shape
+    width = max(ts.max(), frames.max()) - min(ts.min(), frames.min()) + 1.
+    offsets = width * np.arange(Ntraj)
+    alltimes = (ts + offsets[None, :]).T.ravel()
+    return np.searchsorted(alltimes, frames[:, None] + offsets[None, :], side='left') - nts * np.arange(Ntraj)
+
+class TrajectoryOverlay:
+    """
+    All trajectories drawn as a single LineCollection, with start, tick and head markers, updated every frame.
+
+    Which part of each trajectory is visible at each frame is precomputed once (visible_counts),
+    so updating a frame only swaps segments and colours.
+
+    Parameters:
+        ax (cartopy.mpl.geoaxes.GeoAxes): Axes to draw on.
+        xs (numpy.ndarray): Array containing trajectory positions (ntime, 2, ntraj).
+        ts (numpy.ndarray): Array containing trajectory times (ntime, ntraj).
+        frames (numpy.ndarray): Times of each animation frame.
+        colors (numpy.ndarray, optional): Value to colour each trajectory by at each frame (nframe, ntraj).
+        head_colors (numpy.ndarray, optional): Value to colour the head marker of each trajectory by (ntraj,).
+        cmap, norm (optional): Colormap and normalization for colors and head_colors.
+        color (str, optional): Colour of tracks and heads if no values are given.
+        ticks (bool, optional): Add a '+' every 50 points to make tracks clearer.
+        mod (bool, optional): Adjust longitudes of trajectories that cross the prime meridian.
+        zorder (float, optional): zorder of tracks, heads are drawn above.
+    """
+    def __init__(self, ax, xs, ts, frames, colors=None, head_colors=None, cmap=None, norm=None, color='r',
+                 ticks=False, mod=False, zorder=20):
+        self.nts, self.Ntraj = ts.shape
+        self.count = visible_counts(ts, frames)
+        lons = np.stack([sanitize_lonlist(xs[:, 0, i]) for i in range(self.Ntraj)], axis=1) if mod else xs[:, 0, :]
+        #projected once, everything is then drawn in native coordinates
+        self.points = np.stack(project_points(lons, xs[:, 1, :], ax.projection), axis=-1) #(ntime, ntraj, 2)
+        self.colors, self.head_colors = colors, head_colors
+
+        transform = ax.transData #points are already in the axes' projection
+        if colors is None:
+            self.tracks = LineCollection([], linewidths=2., colors=color, transform=transform, zorder=zorder)
+        else:
+            self.tracks = LineCollection([], linewidths=2., cmap=cmap, norm=norm, transform=transform, zorder=zorder)
+        ax.add_collection(self.tracks, autolim=False)
+        self.starts = ax.plot([], [], 'kx', transform=transform, zorder=zorder)[0]
+        self.ticks = ax.plot([], [], 'k+', transform=transform, zorder=zorder)[0] if ticks else None
+        if head_colors is None:
+            self.heads = ax.scatter([], [], color=color, transform=transform, zorder=zorder + 10)
+        else:
+            self.heads = ax.scatter([], [], c=[], cmap=cmap, norm=norm, transform=transform, zorder=zorder + 10)
+
+    def update(self, k):
+        """
+        Show trajectories up to frame k.
+        """
+        n = self.count[k]
+        vis = np.flatnonzero(n > 0) #only plot trajectories less than animation time
+        self.tracks.set_segments([self.points[:n[i], i] for i in vis])
+        if self.colors is not None:
+            self.tracks.set_array(self.colors[k, vis])
+        #'x' at the start of each track
+        self.starts.set_data(self.points[0, vis, 0], self.points[0, vis, 1])
+        if self.ticks is not None:
+            tk = np.concatenate([self.points[25:n[i]:50, i] for i in vis]) if len(vis) else np.empty((0, 2))
+            self.ticks.set_data(tk[:, 0], tk[:, 1])
+        #dot at the current position, until the final timestep
+        head = vis[n[vis] < self.nts]
+        self.heads.set_offsets(self.points[n[head] - 1, head])
+        if self.head_colors is not None:
+            self.heads.set_array(self.head_colors[head])
+        return [a for a in (self.tracks, self.starts, self.ticks, self.heads) if a is not None]
+
+
+#+++Parallel rendering+++#
+def _render_frames(make_figure, frames, args, dpi, first):
+    """
+    Render a block of frames to PNG buffers with a figure owned by this worker.
+    """
+    t0 = time.perf_counter()
+    fig, update = make_figure(args[0], frames, *args[1:])
+    setup = time.perf_counter() - t0
+
+    out = []
+    for k in range(len(frames)):
+        t0 = time.perf_counter()
+        update(k)
+        buf = io.BytesIO()
+        fig.savefig(buf, format='png', dpi=dpi)
+        out.append((first + k, buf.getvalue(), time.perf_counter() - t0))
+    plt.close(fig)
+    return out, setup
+
+def _timing_report(nframes, workers, t_start, t_render, setup, frame_times):
+    #print and return the timing report of render_parallel/render_serial
+    report = {'frames': nframes, 'workers': workers, 'seconds': time.perf_counter() - t_start,
+              'render_seconds': t_render, 'setup_seconds': setup,
+              'frame_mean': frame_times.mean(), 'frame_max': frame_times.max(), 'frame_times': frame_times}
+    print('Rendered {frames} frames on {workers} workers in {seconds:.1f}s ({render_seconds:.1f}s rendering), '
+          '{frame_mean:.2f}s per frame (max {frame_max:.2f}s)'.format(**report))
+    return report
+
+def render_serial(make_figure, frames, args, filename, fps=12, dpi=120):
+    """
+    Render animation frames in this process with matplotlib's FuncAnimation, reporting the same timings
+    as render_parallel (a frame's time runs from its update to the next one, so it includes writing it).
+
+    Parameters:
+        make_figure (function): Figure factory, e.g. _overview_figure, called as make_figure(args[0], frames, *args[1:]).
+        frames (numpy.ndarray): Times of each animation frame.
+        args (tuple): Arguments for make_figure, the dataset first.
+        filename (str): Name of the output file.
+        fps (int, optional): Frames per second.
+        dpi (int, optional): Resolution of each frame.
+
+    Returns:
+        dict: Timing report, total and per-frame render times.
+    """
+    if len(frames) == 0:
+        raise ValueError('No frames to render, check the animation times and step.')
+    t_start = time.perf_counter()
+    fig, update = make_figure(args[0], frames, *args[1:])
+    setup = time.perf_counter() - t_start
+
+    stamps = []
+    def timed_update(k):
+        stamps.append(time.perf_counter())
+        update(k)
+
+    anim = manim.FuncAnimation(fig, timed_update, range(len(frames)), repeat=False)
+    anim.save(filename, fps=fps, codec='h264', dpi=dpi)
+    stamps.append(time.perf_counter())
+    plt.ion()
+
+    #the first update may be FuncAnimation's initial draw, keep the last update of each frame
+    frame_times = np.diff(stamps)[-len(frames):]
+    return _timing_report(len(frames), 1, t_start, time.perf_counter() - t_start, setup, frame_times)
+
+def render_parallel(make_figure, frames, args, filename, fps=12, dpi=120, nproc=None):
+    """
+    Render animation frames across a process pool and stitch them, in order, into a GIF (Pillow) or video (ffmpeg).
+
+    Frames are split into contiguous blocks, one per worker, and each worker builds its own figure
+    with make_figure(args[0], block_frames, *args[1:]) which must return (fig, update(k)).
+
+    Parameters:
+        make_figure (function): Figure factory, e.g. _overview_figure.
+        frames (numpy.ndarray): Times of each animation frame.
+        args (tuple): Arguments for make_figure, the dataset first.
+        filename (str): Name of the output file, .gif is written with Pillow, anything else with ffmpeg.
+        fps (int, optional): Frames per second.
+        dpi (int, optional): Resolution of each frame.
+        nproc (int, optional): Number of worker processes (defaults to all cores).
+
+    Returns:
+        dict: Timing report, total and per-frame render times.
+    """
+    if len(frames) == 0:
+        raise ValueError('No frames to render, check the animation times and step.')
+    t_start = time.perf_counter()
+    nproc = nproc or os.cpu_count()
+    blocks = np.array_split(np.arange(len(frames)), min(nproc, len(frames)))
+
+    with ProcessPoolExecutor(max_workers=len(blocks)) as pool:
+        jobs = [pool.submit(_render_frames, make_figure, frames[b], args, dpi, b[0]) for b in blocks]
+        results = [job.result() for job in jobs]
+    rendered = sorted([r for res, _ in results for r in res])
+    t_render = time.perf_counter() - t_start
+
+    pngs = [png for _, png, _ in rendered]
+    if filename.endswith('.gif'):
+        images = [Image.open(io.BytesIO(png)).convert('RGB') for png in pngs]
+        images[0].save(filename, save_all=True, append_images=images[1:], duration=1000./fps, loop=0)
+    else:
+        #pad to even dimensions for h264
+        cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'image2pipe', '-framerate', str(fps), '-i', '-',
+               '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-c:v', 'libx264', '-pix_fmt', 'yuv420p', filename]
+        subprocess.run(cmd, input=b''.join(pngs), check=True)
+
+    frame_times = np.array([dt for _, _, dt in rendered])
+    return _timing_report(len(frames), len(blocks), t_start, t_render, max(setup for _, setup in results), frame_times)
+
+
+def overview_animation(ds, times, xs, ts=None, filename = './images/overview.gif', step=3600*2, cache_dir=None, nproc=1):
+    """
     Generate an animation providing an overview of a single barotropic model run.
 
     This function creates an animation showing the evolution of vorticity and potential temperature over time,
     along with wind vectors. Optionally, it can overlay trajectories on the plots.
+    Artists are created once and only their data is updated each frame (only the contourf is redrawn),
+    so the boundary, extent, colorbars and quiverkeys are never rebuilt. All fields are
+    interpolated to the frame times up front (see prepare_frames).
 
     Parameters:
         ds (xarray.Dataset): Dataset containing vorticity, potential temperature, and wind data.
@@ -63,117 +426,115 @@ def overview_animation(ds, times, xs, ts=None, filename = './images/overview.gif
         ts (numpy.ndarray, optional): Array containing trajectory times.
         filename (str, optional): Name of the output file.
         step (int, optional): Time step for animation.
+        cache_dir (str, optional): Directory to memory-map prepared frame data from (per block of frames with nproc).
+        nproc (int, optional): Number of processes rendering frames, None for all cores (see render_parallel).
+
+    Returns:
+        dict: Timing report of render_serial or render_parallel.
     """
-	proj=ccrs.NorthPolarStereo()
     #frames to be generated
     frames = np.arange(times[0], times[1], step)
     
     # Check if the specified time period is within the data range
     if times[0] < ds.time.data[0] or times[1] > ds.time.data[-1]:
         raise ValueError('You are trying to animate a time period there is no data for.')
-        
-    skip = 3
-    x = ds.x.data[::skip] #thin wind vectors to make things  a bit more clear.
-    y = ds.y.data[::skip]
+
+    #arguments of the figure factory, cache_dir included so workers also reuse prepared frames
+    args = (ds, xs, ts, cache_dir)
+    if nproc != 1:
+        return render_parallel(_overview_figure, frames, args, filename, fps=12, dpi=120, nproc=nproc)
+    return render_serial(_overview_figure, frames, args, filename, fps=12, dpi=120)
+
+
+def _overview_figure(ds, frames, xs, ts=None, cache_dir=None):
+    """
+    Create the overview figure at frames[0] and a function updating it to frame k.
+    """
+    proj=ccrs.NorthPolarStereo()
+    skip = 3 #thin wind vectors to make things  a bit more clear.
+    fd = prepare_frames(ds, frames, ['u', 'v', 'vortp', 'theta'], skip=skip, thinned=('u', 'v'), cache_dir=cache_dir)
+    #grid, thinned wind points and their vector rotation in the NPS projection, found once
+    X, Y = project_grid(fd['x'], fd['y'], proj)
+    Xe, Ye = project_grid(fd['x'], fd['y'], proj, edges=True)
+    x, y = project_grid(fd['x_thin'], fd['y_thin'], proj)
+    basis = vector_basis(*np.meshgrid(fd['x_thin'], fd['y_thin']), proj)
         
     plt.ioff()
     fig, axs = plt.subplots(1,2, subplot_kw={'projection': proj}, figsize=(5,3.5),sharex=True,sharey=True, dpi=120)
 
-    axs[0].set_extent([-179.9, 179.9, 20, 90], crs=ccrs.PlateCarree())
-
-    make_ax_circular(axs[0])
-    
-    ds = xr.concat([ds, ds.isel(x=slice(0,1)).assign_coords(x=[360])], dim='x')
+    titles = []
+    for ax in axs: #do these to each axes, once
+        make_ax_circular(ax)
+        ax.set_extent([-179.9, 179.9, 20, 90], crs=ccrs.PlateCarree())
+        titles.append(ax.set_title('', fontsize=9))
     
     # Set up color mapping and levels for vorticity
     #temporary patch due to cartopy's bug with certain contourf levels not showing
     cmap = plt.colormaps['bwr']
     norm = BoundaryNorm(np.linspace(-1.5,1.5,6), ncolors=cmap.N, clip=True)      
-    cf=axs[0].pcolormesh(ds.x.data,ds.y.data,ds.vortp.interp(time=0).data*1e5, transform = ccrs.PlateCarree(), 
+    pm=axs[0].pcolormesh(Xe,Ye,fd['vortp'][0]*1e5, transform = proj, shading='flat',
             cmap=cmap,norm=norm)
-    plt.colorbar(cf, ax=axs[0], label= r"$\zeta$' (s$^{-1}$)", orientation='horizontal', shrink=0.9)
+    plt.colorbar(pm, ax=axs[0], label= r"$\zeta$' (s$^{-1}$)", orientation='horizontal', shrink=0.9)
     
     
     # Set up color mapping and levels for potential temperature
     templevs = np.arange(255,300,5)
-    cf=axs[1].contourf(ds.x.data,ds.y.data,ds.theta.interp(time=0).data, transform = ccrs.PlateCarree(), 
+    cf=axs[1].contourf(X,Y,fd['theta'][0], transform = proj, 
             levels = templevs, cmap='RdBu_r', extend='both')
     cbar=plt.colorbar(cf, ax=axs[1], label= r"$\theta$ (K)", orientation='horizontal', shrink=0.9)
     plt.setp(cbar.ax.get_xticklabels()[::2], visible=False)
+    contours = [cf] #the only artist which is replaced each frame
     
     # Plot wind vectors
-    #find thinned winds
-    u = ds.u.interp(time=0).data[::skip, ::skip]
-    v = ds.v.interp(time=0).data[::skip, ::skip]
+    #thinned winds
+    u, v = fd['u'][0], fd['v'][0]
     
     #note we plot u' on vorticity and total u on theta
-    q=axs[0].quiver(x, y, u - u.mean(axis=1)[:,None], v, transform = ccrs.PlateCarree(), 
+    q0=axs[0].quiver(x, y, *rotate_vectors(u - u.mean(axis=1)[:,None], v, basis), transform = proj, 
                     color = '0.2', units='inches', scale=50., width=0.01, pivot = 'mid',zorder=10)
-    axs[0].quiverkey(q, X=0.9, Y=1.0, U=10,label="u' 10 m/s", labelpos='N')
+    axs[0].quiverkey(q0, X=0.9, Y=1.0, U=10,label="u' 10 m/s", labelpos='N')
     
-    q=axs[1].quiver(x, y, u, v, transform = ccrs.PlateCarree(), 
+    q1=axs[1].quiver(x, y, *rotate_vectors(u, v, basis), transform = proj, 
                     color = '0.2', units='inches', scale=100., width=0.01, pivot = 'mid',zorder=10)
-    axs[1].quiverkey(q, X=0.9, Y=1.0, U=10,label='U 10 m/s', labelpos='N')
+    axs[1].quiverkey(q1, X=0.9, Y=1.0, U=10,label='U 10 m/s', labelpos='N')
+
+    #add trajectories if supplied, all tracks in one collection updated every frame
+    if ts is not None:
+        trajs = TrajectoryOverlay(axs[1], xs, ts, frames, color='r', ticks=True, zorder=2)
     
 
-    def anim(t):
-        #find thinned winds at frame time
-        u = ds.u.interp(time=t).data[::skip, ::skip]
-        v = ds.v.interp(time=t).data[::skip, ::skip]
+    def anim(k):
+        t = frames[k]
+        #thinned winds at frame time
+        u, v = fd['u'][k], fd['v'][k]
         
         plt.ioff()
         title = '{:.2f} days'.format(t*s2d)
+        for tt in titles:
+            tt.set_text(title)
+
+        #update vorticity
+        pm.set_array(fd['vortp'][k]*1e5)
+        #replace theta
+        contours.pop().remove()
+        contours.append(axs[1].contourf(X,Y,fd['theta'][k], transform = proj, 
+                    levels =templevs, cmap='RdBu_r', extend='both'))
         
-        for ax in axs: #do these to each axes
-            ax.cla() #clear the axis
-            make_ax_circular(ax)
-            ax.set_extent([-179.9, 179.9, 20, 90], crs=ccrs.PlateCarree())
-            # Set the plot title
-            ax.set_title(title, fontsize=9) #add titile
-
-        #plot vorticity
-        cf=axs[0].pcolormesh(ds.x.data,ds.y.data,ds.vortp.interp(time=t).data*1e5, transform = ccrs.PlateCarree(), 
-            cmap=cmap,norm=norm)
-        #plot theta
-        cf=axs[1].contourf(ds.x.data,ds.y.data,ds.theta.interp(time=t).data, transform = ccrs.PlateCarree(), 
-                    levels =templevs, cmap='RdBu_r', extend='both')
-        
-        #add quivers
-        q=axs[0].quiver(x, y, u - u.mean(axis=1)[:,None], v, transform = ccrs.PlateCarree(), 
-                        color = '0.2', units='inches', scale=50., width=0.01, pivot = 'mid',zorder=10)
-        axs[0].quiverkey(q, X=0.9, Y=1.0, U=10,label="u' 10 m/s", labelpos='N')
-        
-        
-        q=axs[1].quiver(x, y, u, v, transform = ccrs.PlateCarree(), 
-                        color = '0.2', units='inches', scale=100., width=0.01, pivot = 'mid',zorder=10)
-        axs[1].quiverkey(q, X=0.9, Y=1.0, U=10,label='U 10 m/s', labelpos='N')
-            
-
-        #add trajectories if supplied
-        if ts != None:
-            Ntraj = xs.shape[2]
-            for i in range(Ntraj):
-                ind = np.where(ts[:, i] < t)[0] #only plot trajectories less than animation time
-                if len(ind) > 0:
-                    #plot traj in red, add xs every so often to make tracks clearer
-                    ax.plot( xs[ind      , 0, i] ,  xs[ind      , 1, i],  'r', lw=2., transform = ccrs.PlateCarree(),)
-                    ax.plot([xs[ind[0]   , 0, i]], [xs[ind[0]   , 1, i]], 'kx', transform = ccrs.PlateCarree(),)
-                    ax.plot( xs[ind[25::50], 0, i] ,  xs[ind[25::50], 1, i],  'k+', transform = ccrs.PlateCarree(),)
-
-                    if len(ind) < ts.shape[0]: #first timestep condition
-                        ax.plot([xs[ind[-1]  , 0, i]], [xs[ind[-1]  , 1, i]], 'ro', transform = ccrs.PlateCarree(),)
+        #update quivers, rotated into the projection as at the first frame
+        q0.set_UVC(*rotate_vectors(u - u.mean(axis=1)[:,None], v, basis))
+        q1.set_UVC(*rotate_vectors(u, v, basis))
+
+        if ts is not None:
+            trajs.update(k)
 
         plt.ion()
         plt.draw()
 
-    anim = manim.FuncAnimation(fig, anim, frames, repeat=False)
-    
-    anim.save(filename, fps=12, codec='h264', dpi=120)
-    plt.ion()
+    return fig, anim
 
 	
 def animate_thetaens(ds, times, xs, ts=None, tlevs = np.arange(0,12,2),
-                     filename = 'espread.gif', step=3600*2, mod=False):
+                     filename = 'espread.gif', step=3600*2, mod=False, cache_dir=None, nproc=1):
     """
     Animate the spread of theta and optionally include trajectories.
 
@@ -185,7 +546,11 @@ def animate_thetaens(ds, times, xs, ts=None, tlevs = np.arange(0,12,2),
         tlevs (numpy.ndarray, optional): Levels for contour plot.
         filename (str, optional): Name of the output file.
         step (int, optional): Time step for animation.
-        
+        cache_dir (str, optional): Directory to memory-map prepared frame data from (per block of frames with nproc).
+        nproc (int, optional): Number of processes rendering frames, None for all cores (see render_parallel).
+
+    Returns:
+        dict: Timing report of render_serial or render_parallel.
     """
 
     frames = np.arange(times[0], times[1], step)
@@ -194,28 +559,45 @@ def animate_thetaens(ds, times, xs, ts=None, tlevs = np.arange(0,12,2),
     if times[0] < ds.time.data[0] or times[1] > ds.time.data[-1]:
         raise ValueError('You are trying to animate a time period '
                         'there is no data for.')
+
+    args = (ds, xs, ts, tlevs, mod, cache_dir)
+    if nproc != 1:
+        return render_parallel(_thetaens_figure, frames, args, filename, fps=12, dpi=200, nproc=nproc)
+    return render_serial(_thetaens_figure, frames, args, filename, fps=12, dpi=200)
+
+
+def _thetaens_figure(ds, frames, xs, ts=None, tlevs=np.arange(0,12,2), mod=False, cache_dir=None):
+    """
+    Create the ensemble spread figure and a function updating it to frame k.
+    """
     skip = 3
+    proj = ccrs.NorthPolarStereo()
         
     plt.ioff()
     #create figure
     f = plt.figure(3, figsize = (5, 3.5), dpi = 200)
     f.clf()
-    ax = plt.subplot(1, 1, 1, projection = ccrs.NorthPolarStereo())
+    ax = plt.subplot(1, 1, 1, projection = proj)
     ax.set_extent([-179.9, 179.9, 20, 90], crs=ccrs.PlateCarree())
 
     make_ax_circular(ax) #make ciruclar since we'll use NPS projection
     
+    #ensemble spread at every frame time, computed once
+    fd = prepare_frames(ds.theta.std('ens_mem').to_dataset(name='theta_std'), frames, ['theta_std'],
+                        xdim='lon', ydim='lat', cyclic=180, cache_dir=cache_dir)
     # Fix prime meridian issue when plotting
     ds=xr.concat([ds, ds.isel(lon=slice(0,1)).assign_coords(lon=[180])], dim='lon')
     background = ds.theta.sel(ens_mem=0).sel(time=0) #equilibrium temp profile
-    theta = ds.theta.std('ens_mem')
+    #both grids in the NPS projection, found once
+    X, Y = project_grid(fd['lon'], fd['lat'], proj)
+    Xb, Yb = project_grid(background.lon.data, background.lat.data, proj)
     
     #use to get colorbar
     cm = sns.color_palette("light:seagreen", as_cmap=True)
     normcm = mpl.colors.BoundaryNorm(tlevs, cm.N)
     
     #plot contourf of ensemble spread in theta
-    cf=ax.contourf(theta.lon.data, theta.lat.data, theta.interp(time=times[1]).data, transform = ccrs.PlateCarree(), 
+    cf=ax.contourf(X, Y, fd['theta_std'][-1], transform = proj, 
             levels=tlevs,cmap=cm, norm=normcm)
     #add colorbar
     plt.colorbar(cf, ax=ax, label='Std(Temp) (K)',shrink=0.8)
@@ -224,68 +606,50 @@ def animate_thetaens(ds, times, xs, ts=None, tlevs = np.arange(0,12,2),
     btlev= np.arange(250,300,5)
     norm = plt.Normalize(btlev[0], btlev[-1])
     cmap = plt.cm.coolwarm
-    #plot equilibrium temperature profile
-    ax.contour(background.lon.data, background.lat.data, background.data,
-           cmap=cmap, levels=btlev, transform=ccrs.PlateCarree(),linestyles='--', alpha=0.75,zorder=10)
+    #plot equilibrium temperature profile, once
+    ax.contour(Xb, Yb, background.data,
+           cmap=cmap, levels=btlev, transform=proj,linestyles='--', alpha=0.75,zorder=10)
+    title = ax.set_title('', fontsize=9)
+    contours = [cf] #the only artist which is replaced each frame
+
+    if ts is not None:
+        # Get color of each trajectory at each frame based on current temperature, in one vectorized call
+        count = visible_counts(ts, frames)
+        cur = np.maximum(count - 1, 0)
+        mem = np.broadcast_to(np.arange(Ntraj), count.shape)
+        cols = ds.theta.interp(ens_mem=('p', mem.ravel()), time=('p', np.repeat(frames, Ntraj)),
+                               lon=('p', xs[cur, 0, mem].ravel()), lat=('p', xs[cur, 1, mem].ravel())).data.reshape(count.shape)
+        #initial point with a scatter dot, use equilibrium temp.
+        cols0 = ds.theta.interp(ens_mem=('p', np.arange(Ntraj)), time=('p', np.zeros(Ntraj)),
+                                lon=('p', xs[-1, 0, :]), lat=('p', xs[-1, 1, :])).data
+        trajs = TrajectoryOverlay(ax, xs, ts, frames, colors=cols, head_colors=cols0, cmap=cmap, norm=norm, mod=mod)
         
     
-    def anim(t):
+    def anim(k):
         """
         Animate each frame of the plot.
         Parameters:
-            t (int): Frame index.
+            k (int): Frame index.
         """
+        t = frames[k]
         
         plt.ioff()
-        ax.cla()
-        make_ax_circular(ax)
-        ax.set_extent([-179.9, 179.9, 20, 90], crs=ccrs.PlateCarree())
         
-        # Update contourf plot for theta, equil temp contours
-        cf=ax.contourf(theta.lon,theta.lat, theta.interp(time=t).data, transform = ccrs.PlateCarree(), 
-                    cmap=cm, levels=tlevs,norm=normcm)
-        ct=ax.contour(background.lon.data, background.lat.data, background.data,
-           cmap=cmap, levels=btlev, transform=ccrs.PlateCarree(),zorder=10,linestyles='--', alpha=0.75)
+        # Replace contourf plot for theta
+        contours.pop().remove()
+        contours.append(ax.contourf(X, Y, fd['theta_std'][k], transform = proj, 
+                    cmap=cm, levels=tlevs,norm=normcm))
 
         # Set the plot title
-        title = '{:.2f} days'.format(t*s2d)
-        ax.set_title(title, fontsize=9)
+        title.set_text('{:.2f} days'.format(t*s2d))
         
-        for i in range(Ntraj):# plot each individual contour
-            ind = np.where(ts[:, i] < t)[0] #only plot portion of traj that is less than current time
-
-            if len(ind) > 0:
-                #cols = ds.theta.sel(ens_mem=i).interp(time=ts[50::100,i], lon=xs[50::100, 0, i] ,  lat=xs[50::100, 1, i]).values
-                #ax.plot( xs[50::100, 0, i] ,  xs[50::100, 1, i],   c=cmap(norm(cols)), lw=0., marker='o', transform = ccrs.PlateCarree(),)
-                
-                # Get color of trajectory based on current temperature
-                col = ds.theta.sel(ens_mem=i).interp(time=t, lon=xs[ind[-1],0,i], lat=xs[ind[-1],1,i]).item(0)
-                
-                #plot trajectory
-                if mod: #there's a weird artifact that occurs if our traj cross the prime meridian. Adjust if necessary
-                    ax.plot( sanitize_lonlist(xs[ind      , 0, i]) ,  xs[ind      , 1, i],
-                            c=cmap(norm(col)), lw=2., transform = ccrs.PlateCarree(),zorder=20)
-                else:
-                    ax.plot( xs[ind      , 0, i] ,  xs[ind      , 1, i],  c=cmap(norm(col)), lw=2.,
-                            transform = ccrs.PlateCarree(),zorder=20)
-                #plot an 'x' tick every so often to help with clarity
-                ax.plot([xs[ind[0]   , 0, i]], [xs[ind[0]   , 1, i]], 'kx', zorder=20,transform = ccrs.PlateCarree(),)
-                #ax.plot( xs[ind[25::50], 0, i] ,  xs[ind[25::50], 1, i],  'k+', transform = ccrs.PlateCarree(),)
-
-                if len(ind) < ts.shape[0]: #first timestep condition
-                    #initial point with a scatter dot, use equilibrium temp.
-                    col = ds.theta.sel(ens_mem=i).interp(time=0, lon=xs[-1,0,i],lat=xs[-1,1,i]).item(0)
-
-                    ax.scatter([xs[ind[-1]  , 0, i]], [xs[ind[-1]  , 1, i]], c= col, norm=norm, cmap=cmap,
-                     transform=ccrs.PlateCarree(), zorder=30)
+        if ts is not None:
+            trajs.update(k)
 
         plt.ion()
         plt.draw()
 
-    anim = manim.FuncAnimation(f, anim, frames, repeat=False)
-    
-    anim.save(filename, fps=12, codec='h264', dpi=200)
-    plt.ion()
+    return f, anim
     
         
 def sanitize_lonlist(lons):